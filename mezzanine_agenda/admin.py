@@ -12,8 +12,9 @@ from mezzanine.core.admin import DisplayableAdmin, OwnableAdmin
 
 event_fieldsets = deepcopy(DisplayableAdmin.fieldsets)
 event_fieldsets[0][1]["fields"].insert(1, ("start", "end"))
-event_fieldsets[0][1]["fields"].insert(2, "location")
-event_fieldsets[0][1]["fields"].insert(3, "facebook_event")
+event_fieldsets[0][1]["fields"].insert(2, ("rrule", "exdate"))
+event_fieldsets[0][1]["fields"].insert(3, "location")
+event_fieldsets[0][1]["fields"].insert(4, "facebook_event")
 event_fieldsets[0][1]["fields"].extend(["content", "allow_comments"])
 event_list_display = ["title", "user", "status", "admin_link"]
 if settings.EVENT_USE_FEATURED_IMAGE:
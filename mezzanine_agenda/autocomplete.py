@@ -0,0 +1,178 @@
+"""
+Suggestions for event search boxes, from an in-memory sorted index of
+the words in the titles of published events and event locations, so
+that each keystroke is answered without querying the database.
+"""
+from __future__ import unicode_literals
+
+from bisect import bisect_left, insort
+import re
+from threading import Lock
+
+from django.core.urlresolvers import reverse
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+
+from mezzanine_agenda.models import Event, EventLocation
+from mezzanine_agenda.utils import get_cache_version
+from mezzanine.core.models import CONTENT_STATUS_PUBLISHED
+from mezzanine.utils.sites import current_site_id
+
+
+_indexes = {}
+_lock = Lock()
+
+
+def normalize(text):
+    """
+    Returns text lowercased, with its words separated by single spaces.
+    """
+    return " ".join(re.findall(r"\w+", text.lower(), re.UNICODE))
+
+
+class AutocompleteIndex(object):
+    """
+    The titles of a site's published events and of event locations,
+    as a sorted list of ``(key, type, id)`` tuples, where the keys are
+    each title starting from each of its words. Suggestions for a
+    prefix are found by bisecting the list, and events and locations
+    can be added and removed as they're saved and deleted.
+    """
+
+    def __init__(self, site_id, version):
+        self.site_id = site_id
+        self.version = version
+        self.keys = []
+        self.items = {}
+        # Sort the keys once they're all added, rather than inserting
+        # each of them in order.
+        self._sorted = False
+        events = Event._base_manager.filter(site_id=site_id,
+                                            status=CONTENT_STATUS_PUBLISHED)
+        for event in events.only("id", "title", "slug", "status",
+                                 "publish_date", "expiry_date", "site"):
+            self.add_event(event)
+        for location in EventLocation.objects.only("id", "title", "slug"):
+            self.add_location(location)
+        self.keys.sort()
+        self._sorted = True
+
+    def _add(self, item_type, id, title, url, publish_date=None,
+             expiry_date=None):
+        self.remove(item_type, id)
+        words = normalize(title).split()
+        keys = [" ".join(words[i:]) for i in range(len(words))]
+        self.items[item_type, id] = {"type": item_type, "id": id,
+            "title": title, "url": url, "keys": keys,
+            "publish_date": publish_date, "expiry_date": expiry_date}
+        for key in keys:
+            if self._sorted:
+                insort(self.keys, (key, item_type, id))
+            else:
+                self.keys.append((key, item_type, id))
+
+    def add_event(self, event):
+        """
+        Adds or updates an event, removing it if it isn't published.
+        """
+        if event.status != CONTENT_STATUS_PUBLISHED:
+            self.remove("event", event.id)
+            return
+        self._add("event", event.id, event.title, event.get_absolute_url(),
+                  event.publish_date, event.expiry_date)
+
+    def add_location(self, location):
+        """
+        Adds or updates an event location.
+        """
+        url = reverse("event_list_location", args=(location.slug,))
+        self._add("location", location.id, location.title, url)
+
+    def remove(self, item_type, id):
+        """
+        Removes an event or location if it's in the index.
+        """
+        item = self.items.pop((item_type, id), None)
+        if item is not None:
+            for key in item["keys"]:
+                i = bisect_left(self.keys, (key, item_type, id))
+                if i < len(self.keys) and self.keys[i] == (key, item_type, id):
+                    del self.keys[i]
+
+    def suggest(self, query, limit=10):
+        """
+        Returns the published events and locations with titles that
+        contain the query from the start of one of their words, so
+        that "nig" and "jazz ni" both match "Jazz Night".
+        """
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        now = timezone.now()
+        suggestions = []
+        seen = set()
+        i = bisect_left(self.keys, (prefix,))
+        while i < len(self.keys) and len(suggestions) < limit:
+            key, item_type, id = self.keys[i]
+            if not key.startswith(prefix):
+                break
+            i += 1
+            item = self.items.get((item_type, id))
+            if item is None or (item_type, id) in seen:
+                continue
+            if ((item["publish_date"] and item["publish_date"] > now) or
+                    (item["expiry_date"] and item["expiry_date"] < now)):
+                continue
+            seen.add((item_type, id))
+            suggestions.append(dict((name, item[name])
+                                    for name in ("type", "id", "title", "url")))
+        return suggestions
+
+
+def get_autocomplete_index():
+    """
+    Returns the autocomplete index of the current site, rebuilding it
+    when the agenda's cache version has been changed by another
+    process. Changes made in this process update it in place.
+    """
+    site_id = current_site_id()
+    version = get_cache_version()
+    index = _indexes.get(site_id)
+    if index is None or index.version != version:
+        with _lock:
+            index = _indexes.get(site_id)
+            if index is None or index.version != version:
+                index = AutocompleteIndex(site_id, version)
+                _indexes[site_id] = index
+    return index
+
+
+def update_autocomplete_index(sender, instance, **kwargs):
+    """
+    Updates the built indexes in place when an event or location is
+    saved or deleted. Indexes that were current before the change are
+    marked as current with the cache version the change bumped, while
+    those already behind are left to be rebuilt.
+    """
+    deleted = kwargs["signal"] is post_delete
+    with _lock:
+        version = get_cache_version()
+        for index in _indexes.values():
+            if sender is Event:
+                if index.site_id != instance.site_id:
+                    continue
+                if deleted:
+                    index.remove("event", instance.id)
+                else:
+                    index.add_event(instance)
+            elif deleted:
+                index.remove("location", instance.id)
+            else:
+                index.add_location(instance)
+            if index.version == version - 1:
+                index.version = version
+
+
+for sender in (Event, EventLocation):
+    post_save.connect(update_autocomplete_index, sender=sender)
+    post_delete.connect(update_autocomplete_index, sender=sender)
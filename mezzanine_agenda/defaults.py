@@ -57,6 +57,16 @@ register_setting(
     default=5,
 )
 
+register_setting(
+    name="EVENT_CURSOR_PAGINATION",
+    label=_("Cursor pagination"),
+    description=_("If ``True``, event listing pages are paginated with "
+        "next and previous cursors rather than page numbers, so that deep "
+        "pages of a large archive load as quickly as the first."),
+    editable=False,
+    default=False,
+)
+
 register_setting(
     name="EVENT_RSS_LIMIT",
     label=_("Events RSS limit"),
@@ -66,6 +76,44 @@ register_setting(
     default=20,
 )
 
+register_setting(
+    name="EVENT_ICAL_STREAMING",
+    label=_("Stream iCalendar files"),
+    description=_("If ``True``, calendar.ics files for groups of events are "
+        "streamed to the client one event at a time, rather than being "
+        "built in memory before being sent."),
+    editable=False,
+    default=False,
+)
+
+register_setting(
+    name="EVENT_SIDEBAR_CACHE_SECONDS",
+    description=_("Number of seconds the results of the sidebar's template "
+        "tags, such as ``upcoming_events`` and ``event_months``, are cached "
+        "for. Cached results are also cleared whenever events, locations or "
+        "their keywords change."),
+    editable=False,
+    default=60 * 5,
+)
+
+register_setting(
+    name="EVENT_FEED_CACHE_SECONDS",
+    description=_("Number of seconds RSS and Atom feeds are cached for. "
+        "Cached feeds are also cleared whenever events, locations or the "
+        "events page change."),
+    editable=False,
+    default=60 * 60,
+)
+
+register_setting(
+    name="EVENT_OCCURRENCE_HORIZON_DAYS",
+    description=_("Number of days ahead that the occurrences of recurring "
+        "events are stored for. Run the ``extend_occurrences`` command "
+        "daily to keep them stored this far ahead."),
+    editable=False,
+    default=548,
+)
+
 register_setting(
     name="EVENT_SLUG",
     description=_("Slug of the page object for the events."),
@@ -80,6 +128,51 @@ register_setting(
     default="maps.google.com",
 )
 
+register_setting(
+    name="EVENT_GEOCODER",
+    description=_("Dotted path to the geocoder class used to find the "
+        "latitude and longitude of event locations. "
+        "``mezzanine_agenda.geocoders.GazetteerGeocoder`` geocodes offline "
+        "from the ``EVENT_GAZETTEER`` file."),
+    editable=False,
+    default="mezzanine_agenda.geocoders.GoogleGeocoder",
+)
+
+register_setting(
+    name="EVENT_GAZETTEER",
+    description=_("Path to the CSV file or SQLite database of locations "
+        "used by ``mezzanine_agenda.geocoders.GazetteerGeocoder``."),
+    editable=False,
+    default="",
+)
+
+register_setting(
+    name="EVENT_GEOCODE_ASYNC",
+    description=_("If ``True``, locations that need geocoding are queued "
+        "when saved rather than geocoded while validating them. The "
+        "``geocode_worker`` management command processes the queue."),
+    editable=False,
+    default=False,
+)
+
+register_setting(
+    name="EVENT_GEOCODE_CACHE_TTL",
+    description=_("Number of seconds a geocoded mappable location is "
+        "cached for before it is geocoded again. Set to ``None`` to cache "
+        "locations forever."),
+    editable=False,
+    default=60 * 60 * 24 * 30,
+)
+
+register_setting(
+    name="EVENT_GEOCODE_NEGATIVE_CACHE_TTL",
+    description=_("Number of seconds a mappable location that could not be "
+        "geocoded is cached for, so that it fails without querying the "
+        "geocoding service again."),
+    editable=False,
+    default=60 * 60 * 24,
+)
+
 register_setting(
     name="EVENT_TIME_ZONE",
     description="The timezone that event times are written in, if different from the timezone in settings.TIME_ZONE",
@@ -1,13 +1,19 @@
 from __future__ import unicode_literals
 
+from itertools import islice
+
 from django.contrib.syndication.views import Feed
 from django.core.urlresolvers import reverse
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django.utils.feedgenerator import Atom1Feed
+from django.utils import timezone
+from django.utils.feedgenerator import Atom1Feed, Rss201rev2Feed
 from django.utils.html import strip_tags
+from django.utils.xmlutils import SimplerXMLGenerator
 
 from mezzanine.core.templatetags.mezzanine_tags import richtext_filters
 from mezzanine_agenda.models import Event, EventLocation
+from mezzanine_agenda.utils import get_archive_range, get_event_timezone
 from mezzanine.generic.models import Keyword
 from mezzanine.pages.models import Page
 from mezzanine.conf import settings
@@ -17,11 +23,118 @@ from mezzanine.utils.models import get_user_model
 User = get_user_model()
 
 
+class FeedHistoryMixin(object):
+    """
+    Adds the links between pages and archives of a feed described by
+    RFC 5005 to a feed generator. These are given by the ``archive``
+    and ``history_links`` arguments when creating the feed generator.
+    """
+
+    history_namespace = "http://purl.org/syndication/history/1.0"
+
+    def add_history_namespace(self, attributes):
+        if self.feed.get("archive") or self.feed.get("history_links"):
+            attributes["xmlns:fh"] = self.history_namespace
+        return attributes
+
+    def add_history_elements(self, handler, link_element):
+        for rel, href in self.feed.get("history_links", ()):
+            handler.addQuickElement(link_element, None,
+                                    {"rel": rel, "href": href})
+        if self.feed.get("archive"):
+            handler.addQuickElement("fh:archive")
+
+
+class StreamingRssFeed(FeedHistoryMixin, Rss201rev2Feed):
+    """
+    RSS feed generator that can write the start and end of the feed
+    separately from its items, so that items can be streamed.
+    """
+
+    def rss_attributes(self):
+        attributes = super(StreamingRssFeed, self).rss_attributes()
+        return self.add_history_namespace(attributes)
+
+    def add_root_elements(self, handler):
+        super(StreamingRssFeed, self).add_root_elements(handler)
+        self.add_history_elements(handler, "atom:link")
+
+    def write(self, outfile, encoding):
+        handler = SimplerXMLGenerator(outfile, encoding)
+        self.write_head(handler)
+        self.write_items(handler)
+        self.write_tail(handler)
+
+    def write_head(self, handler):
+        handler.startDocument()
+        handler.startElement("rss", self.rss_attributes())
+        handler.startElement("channel", self.root_attributes())
+        self.add_root_elements(handler)
+
+    def write_tail(self, handler):
+        self.endChannelElement(handler)
+        handler.endElement("rss")
+
+
+class StreamingAtomFeed(FeedHistoryMixin, Atom1Feed):
+    """
+    Atom feed generator that can write the start and end of the feed
+    separately from its items, so that items can be streamed.
+    """
+
+    def root_attributes(self):
+        attributes = super(StreamingAtomFeed, self).root_attributes()
+        return self.add_history_namespace(attributes)
+
+    def add_root_elements(self, handler):
+        super(StreamingAtomFeed, self).add_root_elements(handler)
+        self.add_history_elements(handler, "link")
+
+    def write(self, outfile, encoding):
+        handler = SimplerXMLGenerator(outfile, encoding)
+        self.write_head(handler)
+        self.write_items(handler)
+        self.write_tail(handler)
+
+    def write_head(self, handler):
+        handler.startDocument()
+        handler.startElement("feed", self.root_attributes())
+        self.add_root_elements(handler)
+
+    def write_tail(self, handler):
+        handler.endElement("feed")
+
+
+class StreamBuffer(object):
+    """
+    File-like object that collects what's written to it until it's
+    read back with ``pop``.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
 class EventsRSS(Feed):
     """
-    RSS feed for all events.
+    RSS feed for all events. Feeds are paged, and the unfiltered feed
+    is also archived by month, as described by RFC 5005.
     """
 
+    feed_type = StreamingRssFeed
+    format = "rss"
+
+    # Number of events read and written at a time when streaming.
+    stream_chunk_size = 100
+
     def __init__(self, *args, **kwargs):
         """
         Use the title and description of the Events page for the feed's
@@ -32,8 +145,14 @@ class EventsRSS(Feed):
         self.tag = kwargs.pop("tag", None)
         self.location = kwargs.pop("location", None)
         self.username = kwargs.pop("username", None)
+        self.year = kwargs.pop("year", None)
+        self.month = kwargs.pop("month", None)
+        self.page = kwargs.pop("page", 1)
         super(EventsRSS, self).__init__(*args, **kwargs)
         self._public = True
+        self._chunk = None
+        self._history_links = None
+        self._request = None
         try:
             page = Page.objects.published().get(slug=settings.EVENT_SLUG)
         except Page.DoesNotExist:
@@ -58,9 +177,36 @@ class EventsRSS(Feed):
     def link(self):
         return reverse("event_list")
 
+    def feed_url(self):
+        return self._request.get_full_path()
+
+    def get_feed(self, obj, request):
+        self._request = request
+        return super(EventsRSS, self).get_feed(obj, request)
+
+    def feed_extra_kwargs(self, obj):
+        if self._history_links is None:
+            self._history_links = self.get_history_links()
+        return {"archive": self.month is not None,
+                "history_links": self._history_links}
+
     def items(self):
+        if self._chunk is not None:
+            return self._chunk
+        events = self.get_events()
+        limit = settings.EVENT_RSS_LIMIT
+        if limit is not None and self.month is None:
+            offset = (self.page - 1) * limit
+            events = events[offset:offset + limit]
+        return events
+
+    def get_events(self):
+        """
+        Returns the events for the feed, filtered by tag, location or
+        author.
+        """
         if not self._public:
-            return []
+            return Event.objects.none()
         events = Event.objects.published().select_related("user")
         if self.tag:
             tag = get_object_or_404(Keyword, slug=self.tag)
@@ -71,11 +217,93 @@ class EventsRSS(Feed):
         if self.username:
             author = get_object_or_404(User, username=self.username)
             events = events.filter(user=author)
-        limit = settings.EVENT_RSS_LIMIT
-        if limit is not None:
-            events = events[:settings.EVENT_RSS_LIMIT]
+        if self.month is not None:
+            start, end = get_archive_range(self.year, self.month)
+            events = events.filter(start__gte=start, start__lt=end)
         return events
 
+    def get_history_links(self):
+        """
+        Returns the RFC 5005 links from this page of the feed to its
+        other pages, and from the unfiltered feed to its monthly
+        archives. Archives link to the months before and after them
+        that have events, and the current feed links to the last
+        complete month that has events.
+        """
+        links = []
+        absolute = self._request.build_absolute_uri
+        archive = lambda year, month: absolute(reverse("event_feed_archive",
+            kwargs={"format": self.format, "year": year, "month": month}))
+        if self.month is None:
+            limit = settings.EVENT_RSS_LIMIT
+            if limit is not None:
+                url = absolute(self._request.path)
+                pages = max((self.get_events().count() + limit - 1) // limit, 1)
+                links.append(("first", url))
+                if self.page > 1:
+                    links.append(("previous", "%s?page=%s" % (url, self.page - 1)))
+                if self.page < pages:
+                    links.append(("next", "%s?page=%s" % (url, self.page + 1)))
+                links.append(("last", "%s?page=%s" % (url, pages)))
+            if self.page == 1 and not (self.tag or self.location or self.username):
+                now = timezone.now()
+                if settings.USE_TZ:
+                    now = timezone.localtime(now, get_event_timezone())
+                start, end = get_archive_range(now.year, now.month)
+                previous = self._get_month(start__lt=start)
+                if previous is not None:
+                    links.append(("prev-archive", archive(*previous)))
+        else:
+            start, end = get_archive_range(self.year, self.month)
+            current = reverse("event_feed", kwargs={"format": self.format})
+            links.append(("current", absolute(current)))
+            previous = self._get_month(start__lt=start)
+            if previous is not None:
+                links.append(("prev-archive", archive(*previous)))
+            next = self._get_month(start__gte=end)
+            if next is not None and get_archive_range(*next)[1] <= timezone.now():
+                links.append(("next-archive", archive(*next)))
+        return links
+
+    def _get_month(self, **filters):
+        """
+        Returns the year and month of the closest event before or after
+        a point in time, given as a ``start`` filter.
+        """
+        ordering = "-start" if "start__lt" in filters else "start"
+        events = Event.objects.published().filter(**filters)
+        starts = events.order_by(ordering).values_list("start", flat=True)
+        for start in starts[:1]:
+            if settings.USE_TZ:
+                start = timezone.localtime(start, get_event_timezone())
+            return start.year, start.month
+
+    def stream(self, request):
+        """
+        Returns a streaming response for the feed, reading and writing
+        its events a chunk at a time so that a feed of every event is
+        sent without holding all of them in memory.
+        """
+        events = self.get_events().iterator()
+        self._chunk = []
+        feedgen = self.get_feed(None, request)
+        return StreamingHttpResponse(self._stream(request, feedgen, events),
+                                     content_type=feedgen.mime_type)
+
+    def _stream(self, request, feedgen, events):
+        buffer = StreamBuffer()
+        handler = SimplerXMLGenerator(buffer, "utf-8")
+        feedgen.write_head(handler)
+        yield buffer.pop()
+        while True:
+            self._chunk = list(islice(events, self.stream_chunk_size))
+            if not self._chunk:
+                break
+            self.get_feed(None, request).write_items(handler)
+            yield buffer.pop()
+        feedgen.write_tail(handler)
+        yield buffer.pop()
+
     def item_description(self, item):
         return richtext_filters(item.content)
 
@@ -103,7 +331,8 @@ class EventsAtom(EventsRSS):
     Atom feed for all events.
     """
 
-    feed_type = Atom1Feed
+    feed_type = StreamingAtomFeed
+    format = "atom"
 
     def subtitle(self):
         return self.description()
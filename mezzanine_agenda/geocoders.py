@@ -0,0 +1,129 @@
+"""
+Geocoder backends used to find the latitude and longitude of event
+locations. The backend is selected with the ``EVENT_GEOCODER`` setting,
+which is the dotted path to a class with a ``geocode`` method taking a
+mappable location and returning an ``(address, (lat, lon))`` tuple.
+"""
+from __future__ import unicode_literals
+from future.builtins import str
+
+import csv
+import io
+import os
+import sqlite3
+
+from django.utils import six
+
+from geopy.geocoders import GoogleV3 as GoogleMaps
+from geopy.geocoders.googlev3 import GQueryError
+
+from mezzanine.conf import settings
+from mezzanine.utils.importing import import_dotted_path
+
+
+class GeocodeError(Exception):
+    """
+    Raised by geocoders when a mappable location can't be found. Other
+    errors, such as the service being unavailable, are left to propagate
+    so that they aren't cached as missing locations.
+    """
+
+
+def normalize_location(location):
+    """
+    Normalizes a mappable location so that differences in case and
+    whitespace don't matter when looking it up.
+    """
+    return " ".join(location.lower().split())
+
+
+def get_geocoder():
+    """
+    Returns an instance of the geocoder backend selected by the
+    ``EVENT_GEOCODER`` setting.
+    """
+    return import_dotted_path(settings.EVENT_GEOCODER)()
+
+
+def get_geocoder_path(geocoder):
+    """
+    Returns the dotted path to a geocoder's class, in the same form as
+    the ``EVENT_GEOCODER`` setting.
+    """
+    return "%s.%s" % (geocoder.__class__.__module__,
+                      geocoder.__class__.__name__)
+
+
+class GoogleGeocoder(object):
+    """
+    Geocodes with Google Maps, using the ``EVENT_GOOGLE_MAPS_DOMAIN``
+    country domain.
+    """
+
+    service_name = "Google Maps"
+
+    def geocode(self, location):
+        g = GoogleMaps(domain=settings.EVENT_GOOGLE_MAPS_DOMAIN)
+        try:
+            return g.geocode(location.encode("utf-8"))
+        except (GQueryError, ValueError) as e:
+            raise GeocodeError(str(e))
+
+
+class GazetteerGeocoder(object):
+    """
+    Geocodes offline from the local gazetteer given by the
+    ``EVENT_GAZETTEER`` setting. This is either a CSV file with
+    ``location,address,lat,lon`` rows, or an SQLite database with a
+    ``gazetteer`` table of the same columns. Locations are matched
+    after normalizing their case and whitespace.
+    """
+
+    service_name = "the local gazetteer"
+
+    # CSV gazetteers loaded into memory, keyed by path and modified time.
+    _csv_cache = {}
+
+    def __init__(self, path=None):
+        self.path = path or settings.EVENT_GAZETTEER
+
+    def geocode(self, location):
+        location = normalize_location(location)
+        if self.path.lower().endswith(".csv"):
+            row = self._get_csv_entries().get(location)
+        else:
+            connection = sqlite3.connect(self.path)
+            try:
+                row = connection.execute("SELECT address, lat, lon FROM "
+                    "gazetteer WHERE location = ?", (location,)).fetchone()
+            finally:
+                connection.close()
+        if row is None:
+            raise GeocodeError("No match for \"%s\"" % location)
+        address, lat, lon = row
+        return address, (float(lat), float(lon))
+
+    def _get_csv_entries(self):
+        """
+        Returns the CSV gazetteer's entries keyed by normalized location,
+        reloading the file if it has changed.
+        """
+        key = (self.path, os.path.getmtime(self.path))
+        if key not in self._csv_cache:
+            entries = {}
+            for row in self._read_csv():
+                if len(row) == 4:
+                    entries[normalize_location(row[0])] = tuple(row[1:])
+            self._csv_cache.clear()
+            self._csv_cache[key] = entries
+        return self._csv_cache[key]
+
+    def _read_csv(self):
+        if six.PY2:
+            with open(self.path, "rb") as f:
+                for row in csv.reader(f):
+                    yield [cell.decode("utf-8") for cell in row]
+        else:
+            with io.open(self.path, encoding="utf-8", newline="") as f:
+                for row in csv.reader(f):
+                    yield row
@@ -0,0 +1,183 @@
+"""
+A process-local index of published events, used to answer the
+``upcoming_events`` and ``recent_events`` template tags without
+querying for events by date on every page.
+"""
+from __future__ import unicode_literals
+
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+from threading import Lock
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from mezzanine_agenda.models import Event, EventLocation
+from mezzanine_agenda.recurrence import get_occurrences
+from mezzanine_agenda.utils import get_cache_version
+from mezzanine.core.models import CONTENT_STATUS_PUBLISHED
+from mezzanine.generic.models import AssignedKeyword
+from mezzanine.utils.models import get_user_model
+from mezzanine.utils.sites import current_site_id
+
+
+User = get_user_model()
+
+_indexes = {}
+_lock = Lock()
+
+
+class EventIndex(object):
+    """
+    Published events of a site, as tuples of ``(start, effective_end,
+    id, location_id, user_id, has_end, publish_date, expiry_date)``
+    sorted by start, along with the recurrences of recurring events,
+    the ids of events for each keyword, and the ids of locations and
+    authors by their titles, slugs and usernames. Publish and expiry
+    dates are checked when the index is read, so the index only needs
+    rebuilding when events change.
+    """
+
+    def __init__(self, site_id, version):
+        self.site_id = site_id
+        self.version = version
+        events = Event._base_manager.filter(site_id=site_id,
+                                            status=CONTENT_STATUS_PUBLISHED)
+        rows = events.order_by("start", "id").values_list("start",
+            "effective_end", "id", "location_id", "user_id", "end",
+            "publish_date", "expiry_date", "rrule", "exdate")
+        self.events = []
+        # Recurrences of recurring events by id, for finding their
+        # next occurrences.
+        self.recurring = {}
+        for (start, effective_end, id, location_id, user_id, end,
+             publish_date, expiry_date, rrule, exdate) in rows:
+            self.events.append((start, effective_end or start, id,
+                                location_id, user_id, end is not None,
+                                publish_date, expiry_date))
+            if rrule:
+                self.recurring[id] = (start, end, rrule, exdate)
+        self.starts = [event[0] for event in self.events]
+        self.series = [event for event in self.events
+                       if event[2] in self.recurring]
+        # Ongoing events that don't repeat started at most this long ago.
+        self.max_duration = max([event[1] - event[0] for event in self.events
+                                 if event[2] not in self.recurring]
+                                or [timedelta(0)])
+        self.tags = {}
+        keywords = AssignedKeyword.objects.filter(
+            content_type=ContentType.objects.get_for_model(Event))
+        for title, slug, event_id in keywords.values_list("keyword__title",
+                "keyword__slug", "object_pk"):
+            for name in (title, slug):
+                self.tags.setdefault(name, set()).add(int(event_id))
+        self.locations = {}
+        location_ids = set(event[3] for event in self.events)
+        for id, title, slug in EventLocation.objects.filter(
+                id__in=location_ids).values_list("id", "title", "slug"):
+            for name in (title, slug):
+                self.locations.setdefault(name, set()).add(id)
+        user_ids = set(event[4] for event in self.events)
+        self.users = dict(User.objects.filter(id__in=user_ids).values_list(
+            "username", "id"))
+
+    def _get_filter(self, tag, username, location):
+        """
+        Returns a function testing whether an event is published and
+        matches the given tag, author and location, or ``None`` if no
+        events can match them.
+        """
+        now = timezone.now()
+        tag_ids = location_ids = user_id = None
+        if tag is not None:
+            tag_ids = self.tags.get(tag)
+            if not tag_ids:
+                return None
+        if location is not None:
+            location_ids = self.locations.get(location)
+            if not location_ids:
+                return None
+        if username is not None:
+            user_id = self.users.get(username)
+            if user_id is None:
+                return None
+
+        def matches(event):
+            publish_date, expiry_date = event[6:8]
+            return ((publish_date is None or publish_date <= now) and
+                    (expiry_date is None or expiry_date >= now) and
+                    (tag_ids is None or event[2] in tag_ids) and
+                    (location_ids is None or event[3] in location_ids) and
+                    (user_id is None or event[4] == user_id))
+
+        return matches
+
+    def _get_events(self, ids):
+        """
+        Returns the events with the given ids, in the same order.
+        """
+        events = Event._base_manager.filter(site_id=self.site_id)
+        events = events.select_related("user").in_bulk(ids)
+        return [events[id] for id in ids if id in events]
+
+    def upcoming(self, limit, tag=None, username=None, location=None):
+        """
+        Returns the filtered events that are upcoming or ongoing,
+        ordered by start, or by their next occurrence for recurring
+        events.
+        """
+        matches = self._get_filter(tag, username, location)
+        if matches is None:
+            return []
+        now = timezone.now()
+        starts = []
+        i = bisect_left(self.starts, now - self.max_duration)
+        while i < len(self.events) and len(starts) < limit:
+            event = self.events[i]
+            if (event[2] not in self.recurring and event[1] > now and
+                    matches(event)):
+                starts.append((event[0], event[2]))
+            i += 1
+        for event in self.series:
+            if event[1] > now and matches(event):
+                for occurrence in get_occurrences(*self.recurring[event[2]],
+                                                  after=now):
+                    starts.append((occurrence[0], event[2]))
+                    break
+        return self._get_events([id for start, id in sorted(starts)[:limit]])
+
+    def recent(self, limit, tag=None, username=None, location=None):
+        """
+        Returns the filtered events that have ended, most recently
+        started first.
+        """
+        matches = self._get_filter(tag, username, location)
+        if matches is None:
+            return []
+        now = timezone.now()
+        ids = []
+        i = bisect_right(self.starts, now)
+        while i > 0 and len(ids) < limit:
+            i -= 1
+            event = self.events[i]
+            if event[5] and event[1] < now and matches(event):
+                ids.append(event[2])
+        return self._get_events(ids)
+
+
+def get_event_index():
+    """
+    Returns the index of the current site's events, rebuilding it
+    when the agenda's cache version has changed, so that changes made
+    by other processes are picked up.
+    """
+    site_id = current_site_id()
+    version = get_cache_version()
+    index = _indexes.get(site_id)
+    if index is None or index.version != version:
+        with _lock:
+            index = _indexes.get(site_id)
+            if index is None or index.version != version:
+                index = EventIndex(site_id, version)
+                _indexes[site_id] = index
+    return index
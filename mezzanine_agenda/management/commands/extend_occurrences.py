@@ -0,0 +1,73 @@
+from __future__ import unicode_literals
+
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from mezzanine_agenda.models import Event, EventOccurrence
+from mezzanine_agenda.recurrence import get_occurrences
+from mezzanine.conf import settings
+
+
+class Command(BaseCommand):
+    """
+    Stores the occurrences of recurring events up to the horizon.
+    """
+
+    help = ("Stores the occurrences of recurring events up to the "
+            "occurrence horizon, adding those after the last stored "
+            "occurrence of each event. Run daily to keep the horizon "
+            "EVENT_OCCURRENCE_HORIZON_DAYS ahead.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--days", type="int", dest="days", default=None,
+                    help="Number of days ahead to store occurrences for, "
+                         "defaulting to EVENT_OCCURRENCE_HORIZON_DAYS."),
+        make_option("--batch-size", type="int", dest="batch_size",
+                    default=100,
+                    help="Number of events extended in each transaction."),
+    )
+
+    def handle(self, **options):
+        days = options["days"]
+        if days is None:
+            days = settings.EVENT_OCCURRENCE_HORIZON_DAYS
+        horizon = timezone.now() + timedelta(days=days)
+        verbosity = int(options.get("verbosity", 1))
+        events = Event._base_manager.exclude(rrule="").filter(
+            effective_end__gte=timezone.now()).order_by("id")
+        last_id = 0
+        created = 0
+        while True:
+            batch = list(events.filter(id__gt=last_id).values_list("id",
+                "start", "end", "rrule", "exdate")[:options["batch_size"]])
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            stored = dict(EventOccurrence.objects.filter(
+                event_id__in=[values[0] for values in batch]).values(
+                "event_id").annotate(last=Max("start")).values_list(
+                "event_id", "last"))
+            occurrences = []
+            for values in batch:
+                last = stored.get(values[0])
+                for start, end in get_occurrences(*values[1:], after=last,
+                                                  before=horizon):
+                    if last is None or start > last:
+                        occurrences.append(EventOccurrence(
+                            event_id=values[0], start=start, end=end))
+            with transaction.atomic():
+                EventOccurrence.objects.bulk_create(occurrences)
+                Event._base_manager.filter(
+                    Q(occurrences_until__lt=horizon) |
+                    Q(occurrences_until__isnull=True),
+                    id__in=[values[0] for values in batch]).update(
+                    occurrences_until=horizon)
+            created += len(occurrences)
+        if verbosity:
+            self.stdout.write("Stored %s occurrences up to %s." %
+                              (created, horizon))
@@ -0,0 +1,150 @@
+from __future__ import unicode_literals
+from future.builtins import str
+
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+from threading import Lock
+from time import sleep, time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from mezzanine_agenda.geocoders import (GeocodeError, get_geocoder,
+                                        get_geocoder_path)
+from mezzanine_agenda.models import EventLocation, GeocodeResult
+from mezzanine.conf import settings
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls across threads to at most ``rate`` per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = time()
+        self.lock = Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            sleep(delay)
+
+
+class Command(BaseCommand):
+    """
+    Geocodes every event location missing its latitude and longitude.
+    """
+
+    help = ("Geocodes every event location that is missing its latitude "
+            "or longitude, using a pool of threads. Locations without a "
+            "mappable location are geocoded from their address. "
+            "Coordinates that are already set are left alone.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--workers", type="int", dest="workers", default=4,
+                    help="Number of threads geocoding at once."),
+        make_option("--rate", type="float", dest="rate", default=10,
+                    help="Maximum geocoding requests per second, or 0 for "
+                         "no limit."),
+        make_option("--retries", type="int", dest="retries", default=3,
+                    help="Number of times to retry a failed request."),
+        make_option("--backoff", type="float", dest="backoff", default=1,
+                    help="Seconds to wait before the first retry, doubled "
+                         "for each retry after it."),
+        make_option("--batch-size", type="int", dest="batch_size",
+                    default=100,
+                    help="Number of locations saved in each transaction."),
+    )
+
+    def handle(self, **options):
+        self.verbosity = int(options.get("verbosity", 1))
+        self.geocoder = get_geocoder()
+        self.limiter = RateLimiter(options["rate"])
+        self.retries = options["retries"]
+        self.backoff = options["backoff"]
+        domain = settings.EVENT_GOOGLE_MAPS_DOMAIN
+        backend = get_geocoder_path(self.geocoder)
+
+        missing = Q(lat__isnull=True) | Q(lon__isnull=True)
+        locations = list(EventLocation.objects.filter(missing))
+        for location in locations:
+            if not location.mappable_location:
+                location.mappable_location = location.address.replace("\n",
+                                                                      ", ")
+
+        # Cached results are looked up and stored from this thread, so
+        # that only the requests to the geocoder run in the pool.
+        results = {}
+        for location in locations:
+            query = location.mappable_location
+            if query not in results:
+                results[query] = GeocodeResult.objects.lookup(query, domain,
+                                                              backend)
+        queries = [query for query, result in results.items() if not result]
+        pool = ThreadPool(max(options["workers"], 1))
+        try:
+            geocoded = pool.imap_unordered(self.geocode, queries)
+            for query, geocode, error in geocoded:
+                if geocode is not None:
+                    mappable_location, (lat, lon) = geocode
+                    results[query] = GeocodeResult.objects.store(query,
+                        domain, mappable_location, lat, lon, backend=backend)
+                elif isinstance(error, GeocodeError):
+                    results[query] = GeocodeResult.objects.store(query,
+                        domain, error=str(error), backend=backend)
+                else:
+                    self.log(query, error)
+        finally:
+            pool.close()
+            pool.join()
+
+        updated = []
+        for location in locations:
+            result = results[location.mappable_location]
+            if result is None:
+                continue
+            if result.error:
+                self.log(location.mappable_location, result.error)
+                continue
+            location.mappable_location = result.mappable_location
+            location.lat = result.lat
+            location.lon = result.lon
+            updated.append(location)
+        batch_size = max(options["batch_size"], 1)
+        for i in range(0, len(updated), batch_size):
+            # Save each location rather than updating them in bulk, so
+            # that their events' stored icalendar events, search
+            # documents and cached content are updated too.
+            with transaction.atomic():
+                for location in updated[i:i + batch_size]:
+                    location.save()
+        if self.verbosity:
+            self.stdout.write("Geocoded %s of %s locations." %
+                              (len(updated), len(locations)))
+
+    def geocode(self, query):
+        """
+        Geocodes a mappable location, retrying with backoff when the
+        geocoder fails for reasons other than the location not being
+        found. Returns the query with either its geocoded result or
+        the error.
+        """
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            try:
+                return query, self.geocoder.geocode(query), None
+            except GeocodeError as e:
+                return query, None, e
+            except Exception as e:
+                if attempt == self.retries:
+                    return query, None, e
+                sleep(self.backoff * 2 ** attempt)
+
+    def log(self, query, error):
+        if self.verbosity:
+            self.stdout.write("%s: %s" % (query, error))
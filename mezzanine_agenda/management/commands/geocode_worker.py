@@ -0,0 +1,45 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from mezzanine_agenda.geocoders import get_geocoder
+from mezzanine_agenda.models import GeocodeJob
+
+
+class Command(BaseCommand):
+    """
+    Geocodes event locations queued when ``EVENT_GEOCODE_ASYNC`` is set.
+    """
+
+    help = ("Geocodes event locations queued for geocoding when "
+            "EVENT_GEOCODE_ASYNC is set, polling for new jobs.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--once", action="store_true", dest="once",
+                    default=False,
+                    help="Process the queued jobs once and exit."),
+        make_option("--interval", type="float", dest="interval", default=5,
+                    help="Seconds to wait between polls for new jobs."),
+        make_option("--max-attempts", type="int", dest="max_attempts",
+                    default=5,
+                    help="Number of times to try a job before giving up."),
+    )
+
+    def handle(self, **options):
+        geocoder = get_geocoder()
+        verbosity = int(options.get("verbosity", 1))
+        while True:
+            jobs = GeocodeJob.objects.filter(completed__isnull=True,
+                attempts__lt=options["max_attempts"]).select_related("location")
+            for job in jobs:
+                succeeded = job.run(geocoder)
+                if verbosity >= 2 or (verbosity and not succeeded):
+                    self.stdout.write("%s: %s" % (job.query,
+                        job.error or "%s, %s" % (job.location.lat,
+                                                 job.location.lon)))
+            if options["once"]:
+                break
+            sleep(options["interval"])
@@ -0,0 +1,44 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mezzanine_agenda.models import Event
+from mezzanine_agenda.utils import bump_cache_version
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds the stored icalendar events of every event.
+    """
+
+    help = ("Rebuilds the stored icalendar events of every event, such as "
+            "after changing EVENT_URLS_DATE_FORMAT, since their URLs are "
+            "stored with them. They're kept current as events, locations "
+            "and sites change otherwise.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size",
+                    default=100,
+                    help="Number of events rebuilt in each transaction."),
+    )
+
+    def handle(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        events = Event._base_manager.select_related("location").order_by("id")
+        last_id = 0
+        count = 0
+        while True:
+            batch = list(events.filter(id__gt=last_id)[:options["batch_size"]])
+            if not batch:
+                break
+            with transaction.atomic():
+                for event in batch:
+                    event.update_icalendar_vevent()
+            last_id = batch[-1].id
+            count += len(batch)
+        bump_cache_version()
+        if verbosity:
+            self.stdout.write("Rebuilt %s events." % count)
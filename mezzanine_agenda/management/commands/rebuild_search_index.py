@@ -0,0 +1,41 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mezzanine_agenda.models import Event, EventSearchDocument
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds the search documents of every event.
+    """
+
+    help = ("Rebuilds the full-text search documents of every event, such "
+            "as after installing or upgrading. Documents are kept current "
+            "as events change after that.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size",
+                    default=100,
+                    help="Number of events indexed in each transaction."),
+    )
+
+    def handle(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        events = Event._base_manager.select_related("location").order_by("id")
+        last_id = 0
+        count = 0
+        while True:
+            batch = list(events.filter(id__gt=last_id)[:options["batch_size"]])
+            if not batch:
+                break
+            with transaction.atomic():
+                for event in batch:
+                    EventSearchDocument.objects.update_for_event(event)
+            last_id = batch[-1].id
+            count += len(batch)
+        if verbosity:
+            self.stdout.write("Indexed %s events." % count)
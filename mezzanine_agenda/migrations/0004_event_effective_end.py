@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_effective_end(apps, schema_editor):
+    Event = apps.get_model('mezzanine_agenda', 'Event')
+    Event.objects.filter(end__isnull=True).update(
+        effective_end=models.F('start'))
+    Event.objects.filter(end__isnull=False).update(
+        effective_end=models.F('end'))
+
+
+def unset_effective_end(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mezzanine_agenda', '0003_event_index_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='effective_end',
+            field=models.DateTimeField(null=True, editable=False),
+        ),
+        migrations.RunPython(set_effective_end, unset_effective_end),
+        migrations.AlterIndexTogether(
+            name='event',
+            index_together=set([('site', 'status', 'start'), ('site', 'status', 'end'), ('site', 'status', 'effective_end'), ('location', 'start'), ('user', 'start')]),
+        ),
+    ]
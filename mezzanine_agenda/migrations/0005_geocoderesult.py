@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mezzanine_agenda', '0004_event_effective_end'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeResult',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key', models.CharField(unique=True, max_length=40)),
+                ('query', models.TextField()),
+                ('domain', models.CharField(max_length=128)),
+                ('mappable_location', models.CharField(max_length=128, blank=True)),
+                ('lat', models.DecimalField(null=True, max_digits=10, decimal_places=7, blank=True)),
+                ('lon', models.DecimalField(null=True, max_digits=10, decimal_places=7, blank=True)),
+                ('error', models.TextField(blank=True)),
+                ('geocoded', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Geocode Result',
+                'verbose_name_plural': 'Geocode Results',
+            },
+        ),
+    ]
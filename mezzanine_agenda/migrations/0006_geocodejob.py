@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mezzanine_agenda', '0005_geocoderesult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('query', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('completed', models.DateTimeField(null=True, blank=True)),
+                ('location', models.ForeignKey(related_name='geocode_jobs', to='mezzanine_agenda.EventLocation')),
+            ],
+            options={
+                'ordering': ('created',),
+                'verbose_name': 'Geocode Job',
+                'verbose_name_plural': 'Geocode Jobs',
+            },
+        ),
+    ]
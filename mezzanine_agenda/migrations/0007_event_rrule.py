@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mezzanine_agenda', '0006_geocodejob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='rrule',
+            field=models.CharField(help_text='An iCalendar recurrence rule for events that repeat, such as FREQ=WEEKLY;COUNT=10 or FREQ=MONTHLY;BYDAY=1MO. Leave blank for a single event.', max_length=255, verbose_name='Repeats', blank=True),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='exdate',
+            field=models.TextField(help_text="Dates the event doesn't repeat on, one per line in YYYY-MM-DD format.", verbose_name='Except on', blank=True),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from mezzanine_agenda.recurrence import get_occurrence_horizon, get_occurrences
+
+
+def create_occurrences(apps, schema_editor):
+    Event = apps.get_model('mezzanine_agenda', 'Event')
+    EventOccurrence = apps.get_model('mezzanine_agenda', 'EventOccurrence')
+    horizon = get_occurrence_horizon()
+    for event in Event.objects.all().iterator():
+        EventOccurrence.objects.bulk_create([
+            EventOccurrence(event_id=event.id, start=start, end=end)
+            for start, end in get_occurrences(event.start, event.end,
+                event.rrule, event.exdate, before=horizon)])
+
+
+def delete_occurrences(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mezzanine_agenda', '0007_event_rrule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventOccurrence',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('start', models.DateTimeField(verbose_name='Start')),
+                ('end', models.DateTimeField(verbose_name='End')),
+                ('event', models.ForeignKey(related_name='occurrences', to='mezzanine_agenda.Event')),
+            ],
+            options={
+                'ordering': ('start',),
+                'verbose_name': 'Event occurrence',
+                'verbose_name_plural': 'Event occurrences',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='eventoccurrence',
+            index_together=set([('start', 'end', 'event')]),
+        ),
+        migrations.RunPython(create_occurrences, delete_occurrences),
+    ]
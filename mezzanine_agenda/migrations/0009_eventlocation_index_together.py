@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mezzanine_agenda', '0008_eventoccurrence'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='eventlocation',
+            index_together=set([('lat', 'lon')]),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import DatabaseError, migrations, models
+
+
+FTS_TABLE = 'mezzanine_agenda_eventsearchdocument_fts'
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        # FTS5 isn't compiled into every SQLite, in which case search
+        # falls back to LIKE queries.
+        try:
+            with schema_editor.connection.cursor() as cursor:
+                cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+                if not cursor.fetchone()[0]:
+                    return
+        except DatabaseError:
+            return
+        schema_editor.execute("CREATE VIRTUAL TABLE %s USING fts5("
+                              "title, body, tokenize='porter unicode61')"
+                              % FTS_TABLE)
+    elif vendor == 'postgresql':
+        schema_editor.execute("CREATE INDEX %s ON "
+                              "mezzanine_agenda_eventsearchdocument USING gin "
+                              "(to_tsvector('english', title || ' ' || body))"
+                              % FTS_TABLE)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS %s" % FTS_TABLE)
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS %s" % FTS_TABLE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mezzanine_agenda', '0009_eventlocation_index_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventSearchDocument',
+            fields=[
+                ('event', models.OneToOneField(related_name='search_document', primary_key=True, serialize=False, to='mezzanine_agenda.Event')),
+                ('title', models.CharField(max_length=500)),
+                ('body', models.TextField()),
+            ],
+            options={
+                'verbose_name': 'Event search document',
+                'verbose_name_plural': 'Event search documents',
+            },
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mezzanine_agenda', '0010_eventsearchdocument'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='event',
+            index_together=set([('site', 'status', 'start'), ('site', 'status', 'end'), ('site', 'status', 'effective_end'), ('site', 'status', 'location', 'start'), ('site', 'status', 'user', 'start')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mezzanine_agenda', '0011_event_index_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='occurrences_until',
+            field=models.DateTimeField(null=True, editable=False),
+        ),
+    ]
@@ -1,23 +1,38 @@
 from __future__ import unicode_literals
 from future.builtins import str
 
-from django.db import models
+from datetime import datetime, timedelta
+from hashlib import sha1
+
+from django.db import connections, models
+from django.db.models.signals import post_delete, post_save
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
-from django.core.urlresolvers import reverse
+from django.utils import timezone
+from django.utils.html import strip_tags
 from django.utils.translation import ugettext_lazy as _
 
-from geopy.geocoders import GoogleV3 as GoogleMaps
-from geopy.geocoders.googlev3 import GQueryError
-
-from icalendar import Event as IEvent
+from icalendar import Event as IEvent, vRecur
+from icalendar.parser import Parameters
+from icalendar.prop import vDDDLists
 
+from mezzanine_agenda.geocoders import (GeocodeError, get_geocoder,
+                                        get_geocoder_path, normalize_location)
+from mezzanine_agenda.recurrence import (from_local, get_effective_end,
+                                         get_occurrence_horizon,
+                                         get_occurrences, get_recurrence,
+                                         parse_exdate, parse_rrule,
+                                         to_calendar_time, to_local)
+from mezzanine_agenda.utils import (bump_cache_version, forget_for_request,
+                                    get_event_url, get_site_domain)
 from mezzanine.conf import settings
 from mezzanine.core.fields import FileField
 from mezzanine.core.models import Displayable, Ownable, RichText, Slugged
 from mezzanine.generic.fields import CommentsField, RatingField
+from mezzanine.generic.models import AssignedKeyword
+from mezzanine.pages.models import Page
 from mezzanine.utils.models import AdminThumbMixin, upload_to
-from mezzanine.utils.sites import current_site_id
 
 
 class Event(Displayable, Ownable, RichText, AdminThumbMixin):
@@ -27,6 +42,15 @@ class Event(Displayable, Ownable, RichText, AdminThumbMixin):
 
     start = models.DateTimeField(_("Start"))
     end = models.DateTimeField(_("End"), blank=True, null=True)
+    effective_end = models.DateTimeField(editable=False, null=True)
+    rrule = models.CharField(_("Repeats"), max_length=255, blank=True,
+        help_text=_("An iCalendar recurrence rule for events that repeat, "
+                    "such as FREQ=WEEKLY;COUNT=10 or "
+                    "FREQ=MONTHLY;BYDAY=1MO. Leave blank for a single event."))
+    exdate = models.TextField(_("Except on"), blank=True,
+        help_text=_("Dates the event doesn't repeat on, one per line in "
+                    "YYYY-MM-DD format."))
+    occurrences_until = models.DateTimeField(editable=False, null=True)
     location = models.ForeignKey("EventLocation", blank=True, null=True)
     facebook_event = models.BigIntegerField(_('Facebook'), blank=True, null=True) #
     allow_comments = models.BooleanField(verbose_name=_("Allow comments"),
@@ -36,6 +60,7 @@ class Event(Displayable, Ownable, RichText, AdminThumbMixin):
     featured_image = FileField(verbose_name=_("Featured Image"),
         upload_to=upload_to("mezzanine_agenda.Event.featured_image", "event"),
         format="Image", max_length=255, null=True, blank=True)
+    icalendar_vevent = models.TextField(editable=False, blank=True)
 
     admin_thumb_field = "featured_image"
 
@@ -43,6 +68,13 @@ class Event(Displayable, Ownable, RichText, AdminThumbMixin):
         verbose_name = _("Event")
         verbose_name_plural = _("Events")
         ordering = ("-start",)
+        index_together = (
+            ("site", "status", "start"),
+            ("site", "status", "end"),
+            ("site", "status", "effective_end"),
+            ("site", "status", "location", "start"),
+            ("site", "status", "user", "start"),
+        )
 
     def clean(self):
         """
@@ -52,32 +84,45 @@ class Event(Displayable, Ownable, RichText, AdminThumbMixin):
 
         if self.end and self.start > self.end:
             raise ValidationError("Start must be sooner than end.")
+        if self.rrule and self.start:
+            try:
+                get_recurrence(self.start, self.rrule, self.exdate)
+            except (TypeError, ValueError):
+                raise ValidationError("Repeats must be a valid recurrence "
+                                      "rule, and Except on a list of dates.")
+
+    def save(self, *args, **kwargs):
+        """
+        Set the effective end used for upcoming event lookups, which
+        is the end of the last occurrence of a recurring event, and
+        store the serialized icalendar event and the event's
+        occurrences once the event is saved.
+        """
+        self.effective_end = get_effective_end(self.start, self.end,
+                                               self.rrule, self.exdate)
+        super(Event, self).save(*args, **kwargs)
+        self.update_icalendar_vevent()
+        self.update_occurrences()
 
     def get_absolute_url(self):
         """
         URLs for events can either be just their slug, or prefixed
         with a portion of the post's publish date, controlled by the
         setting ``EVENT_URLS_DATE_FORMAT``, which can contain the value
-        ``year``, ``month``, or ``day``. Each of these maps to the name
-        of the corresponding urlpattern, and if defined, we loop through
-        each of these and build up the kwargs for the correct urlpattern.
-        The order which we loop through them is important, since the
-        order goes from least granualr (just year) to most granular
-        (year/month/day).
-        """
-        url_name = "event_detail"
-        kwargs = {"slug": self.slug}
-        date_parts = ("year", "month", "day")
-        if settings.EVENT_URLS_DATE_FORMAT in date_parts:
-            url_name = "event_detail_%s" % settings.EVENT_URLS_DATE_FORMAT
-            for date_part in date_parts:
-                date_value = str(getattr(self.publish_date, date_part))
-                if len(date_value) == 1:
-                    date_value = "0%s" % date_value
-                kwargs[date_part] = date_value
-                if date_part == settings.EVENT_URLS_DATE_FORMAT:
-                    break
-        return reverse(url_name, kwargs=kwargs)
+        ``year``, ``month``, or ``day``. The URL pattern for the setting
+        is only reversed once per request, and each event's slug and
+        date are formatted into it.
+        """
+        return get_event_url(self.slug, self.publish_date)
+
+    def get_occurrences(self, after=None, before=None):
+        """
+        Yields the start and end of each occurrence of the event that
+        is ongoing at or starts after ``after``, and starts before
+        ``before``. Events that don't repeat have a single occurrence.
+        """
+        return get_occurrences(self.start, self.end, self.rrule,
+                               self.exdate, after, before)
 
     def get_icalendar_event(self):
         """
@@ -86,21 +131,90 @@ class Event(Displayable, Ownable, RichText, AdminThumbMixin):
         icalendar_event = IEvent()
         icalendar_event.add('summary'.encode("utf-8"), self.title)
         icalendar_event.add('url', 'http://{domain}{url}'.format(
-            domain=Site.objects.get(id=current_site_id()).domain,
+            domain=get_site_domain(self.site_id),
             url=self.get_absolute_url(),
         ))
         if self.location:
             icalendar_event.add('location'.encode("utf-8"), self.location.address)
         icalendar_event.add('dtstamp', self.start)
-        icalendar_event.add('dtstart', self.start)
+        icalendar_event.add('dtstart', to_calendar_time(self.start))
         if self.end:
-            icalendar_event.add('dtend', self.end)
+            icalendar_event.add('dtend', to_calendar_time(self.end))
+        if self.rrule:
+            icalendar_event.add('rrule', vRecur.from_ical(parse_rrule(self.rrule)))
+            start_time = to_local(self.start).time()
+            exdates = [to_calendar_time(from_local(datetime.combine(date,
+                start_time))) for date in parse_exdate(self.exdate)]
+            if exdates:
+                # A single value holding every date, as older icalendar
+                # releases can't encode a list of dates for one property.
+                exdate = vDDDLists(exdates)
+                zone = getattr(exdates[0].tzinfo, "zone", "UTC")
+                if zone != "UTC":
+                    exdate.params = Parameters({"TZID": zone})
+                icalendar_event.add('exdate', exdate, encode=0)
         icalendar_event['uid'.encode("utf-8")] = "event-{id}@{domain}".format(
             id=self.id,
-            domain=Site.objects.get(id=current_site_id()).domain,
+            domain=get_site_domain(self.site_id),
         ).encode("utf-8")
         return icalendar_event
 
+    def update_icalendar_vevent(self):
+        """
+        Rebuilds and stores the serialized icalendar event, so that
+        calendars can be built by joining together the stored events
+        rather than serializing each event on every request.
+        """
+        vevent = self.get_icalendar_event().to_ical().decode("utf-8")
+        if vevent != self.icalendar_vevent:
+            self.icalendar_vevent = vevent
+            Event._base_manager.filter(id=self.id).update(
+                icalendar_vevent=vevent)
+        return vevent
+
+    def update_occurrences(self, horizon=None):
+        """
+        Stores the event's occurrences up to ``horizon``, defaulting
+        to the occurrence horizon, adding and deleting only those that
+        have changed since they were last stored, and records the
+        horizon they're stored up to.
+        """
+        if horizon is None:
+            horizon = get_occurrence_horizon()
+        stored = dict(((start, end), id) for id, start, end in
+                      self.occurrences.values_list("id", "start", "end"))
+        occurrences = set(self.get_occurrences(before=horizon))
+        deleted = [id for occurrence, id in stored.items()
+                   if occurrence not in occurrences]
+        if deleted:
+            EventOccurrence.objects.filter(id__in=deleted).delete()
+        EventOccurrence.objects.bulk_create([
+            EventOccurrence(event=self, start=start, end=end)
+            for start, end in sorted(occurrences)
+            if (start, end) not in stored])
+        self.occurrences_until = horizon
+        Event._base_manager.filter(id=self.id).update(
+            occurrences_until=horizon)
+
+
+class EventOccurrence(models.Model):
+    """
+    A stored occurrence of an event, so that events occurring within a
+    range of time can be found with an indexed query. Occurrences of
+    recurring events are only stored up to the occurrence horizon,
+    which is recorded on each event as ``occurrences_until``.
+    """
+
+    event = models.ForeignKey("Event", related_name="occurrences")
+    start = models.DateTimeField(_("Start"))
+    end = models.DateTimeField(_("End"))
+
+    class Meta:
+        verbose_name = _("Event occurrence")
+        verbose_name_plural = _("Event occurrences")
+        ordering = ("start",)
+        index_together = (("start", "end", "event"),)
+
 
 class EventLocation(Slugged):
     """
@@ -116,6 +230,7 @@ class EventLocation(Slugged):
         verbose_name = _("Event Location")
         verbose_name_plural = _("Event Locations")
         ordering = ("title",)
+        index_together = (("lat", "lon"),)
 
     def clean(self):
         """
@@ -133,17 +248,344 @@ class EventLocation(Slugged):
             self.mappable_location = self.address.replace("\n",", ")
 
         if self.mappable_location and not (self.lat and self.lon): #location should always override lat/long if set
-            g = GoogleMaps(domain=settings.EVENT_GOOGLE_MAPS_DOMAIN)
-            try:
-                mappable_location, (lat, lon) = g.geocode(self.mappable_location.encode('utf-8'))
-            except GQueryError as e:
-                raise ValidationError("The mappable location you specified could not be found on {service}: \"{error}\" Try changing the mappable location, removing any business names, or leaving mappable location blank and using coordinates from getlatlon.com.".format(service="Google Maps", error=e.message))
-            except ValueError as e:
-                raise ValidationError("The mappable location you specified could not be found on {service}: \"{error}\" Try changing the mappable location, removing any business names, or leaving mappable location blank and using coordinates from getlatlon.com.".format(service="Google Maps", error=e.message))
-            self.mappable_location = mappable_location
-            self.lat = lat
-            self.lon = lon
+            if settings.EVENT_GEOCODE_ASYNC:
+                # Use a cached result if there is one, otherwise leave
+                # the location to be queued for geocoding when saved.
+                result = GeocodeResult.objects.lookup(self.mappable_location,
+                    settings.EVENT_GOOGLE_MAPS_DOMAIN)
+                if result is not None and not result.error:
+                    self.mappable_location = result.mappable_location
+                    self.lat = result.lat
+                    self.lon = result.lon
+                return
+            geocoder = get_geocoder()
+            result = GeocodeResult.objects.geocode(self.mappable_location,
+                                                   geocoder)
+            if result.error:
+                raise ValidationError("The mappable location you specified could not be found on {service}: \"{error}\" Try changing the mappable location, removing any business names, or leaving mappable location blank and using coordinates from getlatlon.com.".format(service=geocoder.service_name, error=result.error))
+            self.mappable_location = result.mappable_location
+            self.lat = result.lat
+            self.lon = result.lon
+
+    def save(self, *args, **kwargs):
+        """
+        Rebuild the stored icalendar events for the location's events,
+        since they contain the location's address, and queue the
+        location for geocoding if ``EVENT_GEOCODE_ASYNC`` is set and it
+        still needs it.
+        """
+        super(EventLocation, self).save(*args, **kwargs)
+        for event in self.event_set.all():
+            event.update_icalendar_vevent()
+        if settings.EVENT_GEOCODE_ASYNC and self.needs_geocoding():
+            GeocodeJob.objects.filter(location=self,
+                                      completed__isnull=True).delete()
+            GeocodeJob.objects.create(location=self,
+                                      query=self.mappable_location)
+
+    def needs_geocoding(self):
+        """
+        Returns whether the location has a mappable location without
+        a latitude and longitude.
+        """
+        return bool(self.mappable_location and not (self.lat and self.lon))
 
     @models.permalink
     def get_absolute_url(self):
         return ("event_list_location", (), {"location": self.slug})
+
+
+class GeocodeResultManager(models.Manager):
+    """
+    Looks up and stores cached geocoding results.
+    """
+
+    def get_key(self, query, domain, backend=None):
+        """
+        Returns the cache key for a mappable location geocoded with the
+        given domain and geocoder backend, which is the dotted path to
+        the geocoder's class and defaults to ``EVENT_GEOCODER``, so that
+        each backend has its own results. Mappable locations are
+        normalized so that case and whitespace differences share a
+        cached result.
+        """
+        if backend is None:
+            backend = settings.EVENT_GEOCODER
+        query = normalize_location(query)
+        key = "%s\n%s\n%s" % (backend, domain, query)
+        return sha1(key.encode("utf-8")).hexdigest()
+
+    def lookup(self, query, domain, backend=None):
+        """
+        Returns the cached result for a mappable location if it hasn't
+        expired, otherwise ``None``.
+        """
+        try:
+            result = self.get(key=self.get_key(query, domain, backend))
+        except self.model.DoesNotExist:
+            return None
+        if result.error:
+            ttl = settings.EVENT_GEOCODE_NEGATIVE_CACHE_TTL
+        else:
+            ttl = settings.EVENT_GEOCODE_CACHE_TTL
+        if ttl is not None:
+            if result.geocoded < timezone.now() - timedelta(seconds=ttl):
+                return None
+        return result
+
+    def geocode(self, query, geocoder=None):
+        """
+        Returns the cached result for a mappable location, geocoding and
+        caching it with the given or configured geocoder if it isn't
+        cached. Errors other than the location not being found are
+        raised without caching them.
+        """
+        if geocoder is None:
+            geocoder = get_geocoder()
+        domain = settings.EVENT_GOOGLE_MAPS_DOMAIN
+        backend = get_geocoder_path(geocoder)
+        result = self.lookup(query, domain, backend)
+        if result is None:
+            try:
+                mappable_location, (lat, lon) = geocoder.geocode(query)
+            except GeocodeError as e:
+                result = self.store(query, domain, error=str(e),
+                                    backend=backend)
+            else:
+                result = self.store(query, domain, mappable_location,
+                                    lat, lon, backend=backend)
+        return result
+
+    def store(self, query, domain, mappable_location="", lat=None, lon=None,
+              error="", backend=None):
+        """
+        Stores the result of geocoding a mappable location. A result
+        with an ``error`` is a location that couldn't be found.
+        """
+        result, created = self.update_or_create(
+            key=self.get_key(query, domain, backend),
+            defaults={"query": query, "domain": domain,
+                      "mappable_location": mappable_location,
+                      "lat": lat, "lon": lon, "error": error})
+        return result
+
+
+class GeocodeResult(models.Model):
+    """
+    A cached result of geocoding a mappable location, so repeated
+    saves of the same location skip the geocoding service. Locations
+    that couldn't be found are cached too, with their error.
+    """
+
+    key = models.CharField(max_length=40, unique=True)
+    query = models.TextField()
+    domain = models.CharField(max_length=128)
+    mappable_location = models.CharField(max_length=128, blank=True)
+    lat = models.DecimalField(max_digits=10, decimal_places=7, blank=True, null=True)
+    lon = models.DecimalField(max_digits=10, decimal_places=7, blank=True, null=True)
+    error = models.TextField(blank=True)
+    geocoded = models.DateTimeField(auto_now=True)
+
+    objects = GeocodeResultManager()
+
+    class Meta:
+        verbose_name = _("Geocode Result")
+        verbose_name_plural = _("Geocode Results")
+
+
+class GeocodeJob(models.Model):
+    """
+    A location queued for geocoding when ``EVENT_GEOCODE_ASYNC`` is set.
+    Jobs are run by the ``geocode_worker`` management command.
+    """
+
+    location = models.ForeignKey("EventLocation", related_name="geocode_jobs")
+    query = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    completed = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name = _("Geocode Job")
+        verbose_name_plural = _("Geocode Jobs")
+        ordering = ("created",)
+
+    def run(self, geocoder=None):
+        """
+        Geocodes the job's mappable location and fills in the location's
+        latitude and longitude, unless the location has been changed
+        since the job was queued. Returns ``False`` if the geocoding
+        service failed and the job should be retried.
+        """
+        self.attempts += 1
+        try:
+            result = GeocodeResult.objects.geocode(self.query, geocoder)
+        except Exception as e:
+            self.error = str(e)
+            self.save()
+            return False
+        self.error = result.error
+        self.completed = timezone.now()
+        self.save()
+        location = self.location
+        if (not result.error and location.needs_geocoding() and
+                location.mappable_location == self.query):
+            location.mappable_location = result.mappable_location
+            location.lat = result.lat
+            location.lon = result.lon
+            location.save()
+        return True
+
+
+class EventSearchDocumentManager(models.Manager):
+    """
+    Keeps the full-text search index of events current.
+    """
+
+    fts_table = "mezzanine_agenda_eventsearchdocument_fts"
+    _backends = {}
+
+    def get_backend(self):
+        """
+        Returns the full-text search the database supports: ``fts5``
+        for SQLite with the FTS5 table created, ``postgresql`` for
+        PostgreSQL, or ``like`` to fall back to ``LIKE`` queries.
+        """
+        connection = connections[self.db]
+        key = (connection.alias, connection.settings_dict["NAME"])
+        if key not in self._backends:
+            backend = "like"
+            if connection.vendor == "postgresql":
+                backend = "postgresql"
+            elif connection.vendor == "sqlite":
+                if self.fts_table in connection.introspection.table_names():
+                    backend = "fts5"
+            self._backends[key] = backend
+        return self._backends[key]
+
+    def update_for_event(self, event):
+        """
+        Rebuilds the search document of an event from its title,
+        content, keywords and location.
+        """
+        event_type = ContentType.objects.get_for_model(Event)
+        keywords = AssignedKeyword.objects.filter(content_type=event_type,
+            object_pk=event.id).values_list("keyword__title", flat=True)
+        body = [strip_tags(event.content)] + list(keywords)
+        if event.location_id:
+            body.extend([event.location.title, event.location.address])
+        title, body = event.title, "\n".join(body)
+        self.update_or_create(event_id=event.id,
+                              defaults={"title": title, "body": body})
+        if self.get_backend() == "fts5":
+            cursor = connections[self.db].cursor()
+            cursor.execute("DELETE FROM %s WHERE rowid = %%s" %
+                           self.fts_table, [event.id])
+            cursor.execute("INSERT INTO %s (rowid, title, body) "
+                           "VALUES (%%s, %%s, %%s)" % self.fts_table,
+                           [event.id, title, body])
+
+    def delete_for_event(self, event_id):
+        """
+        Removes the search document of a deleted event.
+        """
+        self.filter(event_id=event_id).delete()
+        if self.get_backend() == "fts5":
+            cursor = connections[self.db].cursor()
+            cursor.execute("DELETE FROM %s WHERE rowid = %%s" %
+                           self.fts_table, [event_id])
+
+
+class EventSearchDocument(models.Model):
+    """
+    The text of an event searched by the agenda's full-text search,
+    indexed with SQLite's FTS5 or a PostgreSQL GIN index.
+    """
+
+    event = models.OneToOneField("Event", primary_key=True,
+                                 related_name="search_document")
+    title = models.CharField(max_length=500)
+    body = models.TextField()
+
+    objects = EventSearchDocumentManager()
+
+    class Meta:
+        verbose_name = _("Event search document")
+        verbose_name_plural = _("Event search documents")
+
+
+def event_changed(sender, instance, **kwargs):
+    """
+    Invalidate cached content built from events when an event, a
+    location, or an event's keywords change.
+    """
+    if sender is AssignedKeyword:
+        event_type = ContentType.objects.get_for_model(Event)
+        if instance.content_type_id != event_type.id:
+            return
+    bump_cache_version()
+
+
+for sender in (Event, EventLocation, AssignedKeyword):
+    post_save.connect(event_changed, sender=sender)
+    post_delete.connect(event_changed, sender=sender)
+
+
+def update_search_document(sender, instance, **kwargs):
+    """
+    Keep the search documents of events current when an event, its
+    location, or its keywords change.
+    """
+    documents = EventSearchDocument.objects
+    if sender is Event:
+        documents.update_for_event(instance)
+    elif sender is EventLocation:
+        for event in instance.event_set.all():
+            documents.update_for_event(event)
+    else:
+        event_type = ContentType.objects.get_for_model(Event)
+        if instance.content_type_id == event_type.id:
+            for event in Event._base_manager.filter(id=instance.object_pk):
+                documents.update_for_event(event)
+
+
+def delete_search_document(sender, instance, **kwargs):
+    """
+    Remove the search document of a deleted event.
+    """
+    EventSearchDocument.objects.delete_for_event(instance.id)
+
+
+for sender in (Event, EventLocation, AssignedKeyword):
+    post_save.connect(update_search_document, sender=sender)
+post_delete.connect(update_search_document, sender=AssignedKeyword)
+post_delete.connect(delete_search_document, sender=Event)
+
+
+def events_page_changed(sender, instance, **kwargs):
+    """
+    Invalidate cached feeds when the events page changes, since they
+    use its title and description.
+    """
+    if isinstance(instance, Page) and instance.slug == settings.EVENT_SLUG:
+        bump_cache_version()
+
+
+post_save.connect(events_page_changed)
+post_delete.connect(events_page_changed)
+
+
+def site_changed(sender, instance, **kwargs):
+    """
+    Rebuild the stored icalendar events of a site's events when the
+    site is saved, since their URLs and UIDs contain its domain.
+    """
+    forget_for_request(("domain", instance.id))
+    events = Event._base_manager.filter(site_id=instance.id)
+    for event in events.select_related("location").iterator():
+        event.update_icalendar_vevent()
+    bump_cache_version()
+
+
+post_save.connect(site_changed, sender=Site)
@@ -0,0 +1,98 @@
+"""
+Searching for upcoming events near a point, using the latitude and
+longitude of event locations. Locations are first narrowed down in the
+database with a bounding box over their indexed coordinates, and then
+ranked by their exact distance, so no spatial database is needed.
+"""
+from __future__ import unicode_literals
+
+from math import asin, cos, radians, sin, sqrt
+
+from django.db.models import Q
+from django.utils import timezone
+
+from mezzanine_agenda.models import Event, EventLocation
+
+
+# Mean radius of the Earth in kilometres.
+EARTH_RADIUS = 6371.0088
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Returns the great-circle distance in kilometres between two points.
+    """
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = (sin((lat2 - lat1) / 2) ** 2 +
+         cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * asin(min(1, sqrt(a)))
+
+
+def get_bounding_box(lat, lon, distance):
+    """
+    Returns a filter for locations within a box around a point that
+    contains every location within ``distance`` kilometres of it. The
+    box is split in two where it crosses the antimeridian.
+    """
+    lat_delta = distance / (EARTH_RADIUS * radians(1))
+    min_lat, max_lat = max(lat - lat_delta, -90), min(lat + lat_delta, 90)
+    if min_lat == -90 or max_lat == 90:
+        # Close enough to a pole for every longitude to be in range.
+        return Q(lat__range=(min_lat, max_lat))
+    lon_delta = lat_delta / cos(radians(max(abs(min_lat), abs(max_lat))))
+    if lon_delta >= 180:
+        return Q(lat__range=(min_lat, max_lat))
+    min_lon, max_lon = lon - lon_delta, lon + lon_delta
+    if min_lon < -180:
+        lon_range = (Q(lon__gte=min_lon + 360) |
+                     Q(lon__range=(-180, max_lon)))
+    elif max_lon > 180:
+        lon_range = (Q(lon__range=(min_lon, 180)) |
+                     Q(lon__lte=max_lon - 360))
+    else:
+        lon_range = Q(lon__range=(min_lon, max_lon))
+    return Q(lat__range=(min_lat, max_lat)) & lon_range
+
+
+def get_nearby_events(lat, lon, distance, limit=None, events=None):
+    """
+    Returns upcoming or ongoing events within ``distance`` kilometres
+    of a point, nearest first and then by start, with the distance to
+    each set as ``distance``. Events are looked up with the locations
+    in the bounding box as a subquery, and when limited, only up to
+    ``limit`` of them are read for each location, nearest first, until
+    there are enough.
+    """
+    lat, lon, distance = float(lat), float(lon), float(distance)
+    locations = EventLocation.objects.filter(get_bounding_box(lat, lon,
+                                                              distance))
+    distances = {}
+    for id, location_lat, location_lon in locations.values_list("id", "lat",
+                                                                "lon"):
+        location_distance = haversine(lat, lon, float(location_lat),
+                                      float(location_lon))
+        if location_distance <= distance:
+            distances[id] = location_distance
+    if not distances:
+        return []
+    if events is None:
+        events = Event.objects.published()
+    events = events.filter(location__in=locations.values("id"),
+                           effective_end__gt=timezone.now())
+    events = events.select_related("location", "user").order_by("start")
+    if limit is None:
+        nearby = [event for event in events if event.location_id in distances]
+    else:
+        location_ids = set(events.order_by().values_list("location_id",
+                                                         flat=True).distinct())
+        nearby = []
+        for location_id in sorted(location_ids & set(distances),
+                                  key=lambda id: (distances[id], id)):
+            if len(nearby) >= limit:
+                break
+            nearby.extend(events.filter(location_id=location_id)[
+                :limit - len(nearby)])
+    for event in nearby:
+        event.distance = distances[event.location_id]
+    nearby.sort(key=lambda event: (event.distance, event.start))
+    return nearby
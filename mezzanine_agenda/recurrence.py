@@ -0,0 +1,231 @@
+"""
+Expansion of recurring events into their occurrences. Recurring
+events store an iCalendar ``RRULE`` and a list of excluded dates, and
+their occurrences are generated lazily, only within the window asked
+for, rather than being stored as separate events.
+"""
+from __future__ import unicode_literals
+
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+from dateutil.rrule import rrulestr
+from django.db.models import Q
+from django.utils import timezone
+from icalendar import Timezone
+from icalendar.cal import Component
+
+from mezzanine_agenda.utils import get_event_timezone
+from mezzanine.conf import settings
+
+
+# The effective end of a series that recurs forever.
+FAR_FUTURE = datetime(9999, 12, 1)
+
+# The earliest time that timezone observances are described from.
+EPOCH = datetime(1970, 1, 1)
+
+
+def parse_rrule(rrule):
+    """
+    Returns a recurrence rule without any ``RRULE:`` prefix.
+    """
+    rrule = rrule.strip()
+    if rrule.upper().startswith("RRULE:"):
+        rrule = rrule[len("RRULE:"):]
+    return rrule
+
+
+def parse_exdate(exdate):
+    """
+    Returns the dates given one per line in ``YYYY-MM-DD`` format.
+    Raises ``ValueError`` for an invalid date.
+    """
+    return sorted(set(datetime.strptime(line.strip(), "%Y-%m-%d").date()
+                      for line in exdate.splitlines() if line.strip()))
+
+
+def is_infinite(rrule):
+    """
+    Returns whether a recurrence rule recurs forever, having neither
+    a count nor an end date.
+    """
+    parts = [part.split("=")[0] for part in parse_rrule(rrule).upper().split(";")]
+    return "COUNT" not in parts and "UNTIL" not in parts
+
+
+def to_local(value):
+    """
+    Returns a datetime as a naive datetime in the timezone events are
+    written in.
+    """
+    if settings.USE_TZ and timezone.is_aware(value):
+        return timezone.make_naive(value, get_event_timezone())
+    return value
+
+
+def from_local(value):
+    """
+    Returns a naive datetime in the timezone events are written in as
+    an aware datetime when time zone support is enabled. Times that
+    are skipped or repeated by daylight saving changes don't raise
+    errors, as they can be generated by recurrence rules.
+    """
+    if settings.USE_TZ:
+        event_timezone = get_event_timezone()
+        if hasattr(event_timezone, "localize"):
+            return event_timezone.normalize(event_timezone.localize(value))
+        return timezone.make_aware(value, event_timezone)
+    return value
+
+
+def to_calendar_time(value):
+    """
+    Returns a datetime for writing to iCalendar files, in the timezone
+    events are written in when it has a name to give as its ``TZID``,
+    so that calendar clients expand recurrence rules in the same local
+    time as we do, or otherwise in UTC.
+    """
+    if not settings.USE_TZ:
+        return value
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    event_timezone = get_event_timezone()
+    if not hasattr(event_timezone, "zone"):
+        event_timezone = timezone.utc
+    return value.astimezone(event_timezone)
+
+
+def get_vtimezone(since=None):
+    """
+    Returns an iCalendar ``VTIMEZONE`` describing the timezone events
+    are written in, which event times given by ``to_calendar_time``
+    refer to by its ``TZID``, or ``None`` if they're written in UTC.
+    Only the observances in effect from ``since``, or from 1970 at the
+    earliest, onwards are given.
+    """
+    if not settings.USE_TZ:
+        return None
+    event_timezone = get_event_timezone()
+    if getattr(event_timezone, "zone", "UTC") == "UTC":
+        return None
+    try:
+        transitions = list(zip(event_timezone._utc_transition_times,
+                               event_timezone._transition_info))
+    except AttributeError:
+        # A timezone with a fixed offset.
+        transitions = [(datetime.min, (event_timezone._utcoffset,
+                        timedelta(0), event_timezone._tzname))]
+    since = max(EPOCH, timezone.make_naive(since, timezone.utc)
+                       if since is not None else EPOCH)
+    first = max(bisect_right([utc for utc, _ in transitions], since) - 1, 0)
+    vtimezone = Timezone()
+    vtimezone.add("tzid", event_timezone.zone)
+    for i in range(first, len(transitions)):
+        utc, (offset, dst, name) = transitions[i]
+        if i == first and utc < EPOCH:
+            offset_from, start = offset, EPOCH
+        else:
+            offset_from = transitions[i - 1][1][0]
+            start = utc + offset_from
+        observance = Component()
+        observance.name = "DAYLIGHT" if dst else "STANDARD"
+        observance.add("dtstart", start)
+        observance.add("tzoffsetfrom", offset_from)
+        observance.add("tzoffsetto", offset)
+        observance.add("tzname", name)
+        vtimezone.add_component(observance)
+    return vtimezone
+
+
+def get_recurrence(start, rrule, exdate=""):
+    """
+    Returns a ``dateutil`` rule set of the starts of a recurring event,
+    as naive datetimes in the timezone events are written in, so that
+    occurrences keep their time of day across daylight saving changes.
+    Raises ``ValueError`` for an invalid rule or excluded date.
+    """
+    local_start = to_local(start)
+    recurrence = rrulestr(parse_rrule(rrule), dtstart=local_start,
+                          forceset=True)
+    for date in parse_exdate(exdate):
+        recurrence.exdate(datetime.combine(date, local_start.time()))
+    return recurrence
+
+
+def get_occurrences(start, end=None, rrule="", exdate="",
+                    after=None, before=None):
+    """
+    Yields the start and end of each occurrence of an event that is
+    ongoing at or starts after ``after``, and starts before ``before``.
+    Occurrences of recurring events are generated one at a time, so
+    an infinite series can be read up to the end of a window.
+    """
+    if settings.USE_TZ and timezone.is_naive(start):
+        # Events are given naive times before they're saved.
+        default_timezone = timezone.get_default_timezone()
+        start = timezone.make_aware(start, default_timezone)
+        if end is not None:
+            end = timezone.make_aware(end, default_timezone)
+    duration = (end or start) - start
+    if rrule:
+        starts = (from_local(value) for value in
+                  get_recurrence(start, rrule, exdate))
+    else:
+        starts = [start]
+    for occurrence in starts:
+        if before is not None and occurrence >= before:
+            break
+        if after is None or occurrence + duration > after or occurrence >= after:
+            yield occurrence, occurrence + duration
+
+
+def get_effective_end(start, end=None, rrule="", exdate=""):
+    """
+    Returns the end of the last occurrence of an event, or a date far
+    in the future for a series that recurs forever.
+    """
+    if not rrule:
+        return end or start
+    if is_infinite(rrule):
+        return from_local(FAR_FUTURE)
+    last = None
+    for last in get_occurrences(start, end, rrule, exdate):
+        pass
+    return last[1] if last else end or start
+
+
+def get_occurrence_horizon():
+    """
+    Returns the time up to which the occurrences of recurring events
+    are stored, which is ``EVENT_OCCURRENCE_HORIZON_DAYS`` from now.
+    """
+    days = settings.EVENT_OCCURRENCE_HORIZON_DAYS
+    return timezone.now() + timedelta(days=days)
+
+
+def filter_occurring(events, start, end):
+    """
+    Filters events to those starting within a range of time, including
+    recurring events with an occurrence starting within it. Recurring
+    events are looked up in their stored occurrences, and those whose
+    occurrences aren't stored up to the end of the range are expanded
+    from their recurrence rules. Other events are matched by their
+    start, since those saved before the horizon reached them have no
+    stored occurrence.
+    """
+    from mezzanine_agenda.models import EventOccurrence
+    occurrences = EventOccurrence.objects.filter(start__gte=start,
+                                                 start__lt=end)
+    series = events.exclude(rrule="").filter(
+        Q(occurrences_until__lt=end) | Q(occurrences_until__isnull=True),
+        start__lt=end, effective_end__gte=start)
+    ids = []
+    for values in series.values_list("id", "start", "end", "rrule", "exdate"):
+        for occurrence in get_occurrences(*values[1:], after=start, before=end):
+            if occurrence[0] >= start:
+                ids.append(values[0])
+                break
+    return events.filter(Q(start__gte=start, start__lt=end) |
+                         Q(id__in=occurrences.values("event_id")) |
+                         Q(id__in=ids))
@@ -0,0 +1,124 @@
+"""
+Full-text search of events, ranked by relevance and paginated by
+cursor. Searches use SQLite's FTS5 or PostgreSQL's text search when
+available, and fall back to ``LIKE`` queries otherwise.
+"""
+from __future__ import unicode_literals
+
+import re
+
+from django.core import signing
+from django.db import connections
+from django.db.models import Q
+
+from mezzanine_agenda.models import Event, EventSearchDocument
+from mezzanine_agenda.utils import CursorPage
+
+
+# Searches are limited to this many terms.
+MAX_TERMS = 10
+
+
+def get_terms(query):
+    """
+    Returns the words searched for in a query.
+    """
+    return re.findall(r"\w+", query.lower(), re.UNICODE)[:MAX_TERMS]
+
+
+def _encode_cursor(rank, event_id):
+    return signing.dumps([rank, event_id], salt="mezzanine_agenda.search")
+
+
+def _decode_cursor(cursor):
+    try:
+        rank, event_id = signing.loads(cursor, salt="mezzanine_agenda.search")
+        return float(rank), int(event_id)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+
+
+def _rank_fts5(terms, after, limit):
+    documents = EventSearchDocument.objects
+    query = " ".join('"%s"' % term for term in terms)
+    sql = ("SELECT rank, event_id FROM (SELECT bm25(%s, 10.0, 1.0) AS rank, "
+           "rowid AS event_id FROM %s WHERE %s MATCH %%s)" %
+           ((documents.fts_table,) * 3))
+    params = [query]
+    if after is not None:
+        sql += " WHERE rank > %s OR (rank = %s AND event_id > %s)"
+        params.extend([after[0], after[0], after[1]])
+    sql += " ORDER BY rank, event_id LIMIT %s"
+    cursor = connections[documents.db].cursor()
+    cursor.execute(sql, params + [limit])
+    return cursor.fetchall()
+
+
+def _rank_postgresql(terms, after, limit):
+    documents = EventSearchDocument.objects
+    vector = "to_tsvector('english', title || ' ' || body)"
+    query = "plainto_tsquery('english', %s)"
+    sql = ("SELECT rank, event_id FROM (SELECT -ts_rank(%s, %s) AS rank, "
+           "event_id FROM %s WHERE %s @@ %s) AS ranked" % (vector, query,
+           EventSearchDocument._meta.db_table, vector, query))
+    params = [" ".join(terms)] * 2
+    if after is not None:
+        sql += " WHERE rank > %s OR (rank = %s AND event_id > %s)"
+        params.extend([after[0], after[0], after[1]])
+    sql += " ORDER BY rank, event_id LIMIT %s"
+    cursor = connections[documents.db].cursor()
+    cursor.execute(sql, params + [limit])
+    return cursor.fetchall()
+
+
+def _rank_like(terms, after, limit):
+    documents = EventSearchDocument.objects.all()
+    for term in terms:
+        documents = documents.filter(Q(title__icontains=term) |
+                                     Q(body__icontains=term))
+    ranked = []
+    for event_id, title, body in documents.values_list("event_id", "title",
+                                                       "body"):
+        title, body = title.lower(), body.lower()
+        rank = -sum(title.count(term) * 10 + body.count(term)
+                    for term in terms)
+        if after is None or (rank, event_id) > after:
+            ranked.append((float(rank), event_id))
+    return sorted(ranked)[:limit]
+
+
+def search_events(query, cursor=None, per_page=10, events=None):
+    """
+    Returns a ``CursorPage`` of the events matching a search query,
+    most relevant first, with a cursor for the next page if there is
+    one. Matches in an event's title count for more than matches in
+    its content, keywords or location. Only events in ``events``,
+    defaulting to published events, are returned.
+    """
+    terms = get_terms(query)
+    if not terms:
+        return CursorPage([])
+    if events is None:
+        events = Event.objects.published()
+    events = events.select_related("location", "user")
+    rank = {"fts5": _rank_fts5, "postgresql": _rank_postgresql,
+            "like": _rank_like}[EventSearchDocument.objects.get_backend()]
+    after = _decode_cursor(cursor) if cursor else None
+    results = []
+    # Matches that aren't in ``events``, such as unpublished events,
+    # are skipped, so keep reading ranked matches until the page is full.
+    while len(results) <= per_page:
+        batch = rank(terms, after, per_page + 1)
+        if not batch:
+            break
+        found = events.in_bulk([event_id for _, event_id in batch])
+        results.extend((match, found[match[1]]) for match in batch
+                       if match[1] in found)
+        after = tuple(batch[-1])
+        if len(batch) <= per_page:
+            break
+    next_cursor = None
+    if len(results) > per_page:
+        results = results[:per_page]
+        next_cursor = _encode_cursor(*results[-1][0])
+    return CursorPage([event for _, event in results], next_cursor)
@@ -1,25 +1,29 @@
 from __future__ import unicode_literals
 from datetime import datetime
+from hashlib import md5
 
 from django import template
-from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.db.models import Count, Q
+from django.db.models import (Case, Count, IntegerField, Sum, Value,
+                              When)
 from django.utils import timezone
 from django.utils.http import urlquote as quote
 from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
 
+from mezzanine_agenda.index import get_event_index
 from mezzanine_agenda.models import Event, EventLocation
+from mezzanine_agenda.proximity import get_nearby_events
+from mezzanine_agenda.utils import (get_archive_range, get_cache_version,
+                                    get_event_timezone, get_site_domain)
 from mezzanine.conf import settings
 from mezzanine.core.managers import SearchableQuerySet
-from mezzanine.generic.models import Keyword
 from mezzanine.pages.models import Page
 from mezzanine.template import Library
 from mezzanine.utils.models import get_user_model
 from mezzanine.utils.sites import current_site_id
 
-import pytz
-
 from time import strptime
 
 User = get_user_model()
@@ -27,31 +31,59 @@ User = get_user_model()
 register = Library()
 
 
+def _cached_tag(get_result, *args):
+    """
+    Returns the result of one of the sidebar's tags from the cache,
+    calling ``get_result`` with the tag's arguments to build it when it
+    isn't cached. Cache keys include the site and language, and the
+    agenda's cache version, which changes whenever events, locations
+    or their keywords do.
+    """
+    args_hash = md5(repr(args).encode("utf-8")).hexdigest()
+    key = "mezzanine_agenda.%s.%s.%s.%s.%s" % (get_cache_version(),
+        get_result.__name__, current_site_id(), get_language(), args_hash)
+    result = cache.get(key)
+    if result is None:
+        result = get_result(*args)
+        cache.set(key, result, settings.EVENT_SIDEBAR_CACHE_SECONDS)
+    return result
+
+
+def _event_months():
+    """
+    Returns the months events start in, with a count of their events.
+    The months are found by the database, in the timezone events are
+    written in, and their events are then counted in a single query.
+    """
+    events = Event.objects.published()
+    tzinfo = get_event_timezone() if settings.USE_TZ else None
+    months = list(events.datetimes("start", "month", order="DESC",
+                                   tzinfo=tzinfo))
+    counts = {}
+    for i, month in enumerate(months):
+        start, end = get_archive_range(month.year, month.month)
+        counts["month_%s" % i] = Sum(Case(When(start__gte=start,
+            start__lt=end, then=Value(1)), default=Value(0),
+            output_field=IntegerField()))
+    if counts:
+        counts = events.order_by().aggregate(**counts)
+    return [{"date": datetime(month.year, month.month, 1),
+             "event_count": counts["month_%s" % i]}
+            for i, month in enumerate(months)]
+
+
 @register.as_tag
 def event_months(*args):
     """
-    Put a list of dates for events into the template context.
+    Put a list of dates for events into the template context. Months
+    are counted by the database, in the timezone events are written in.
     """
-    if settings.EVENT_TIME_ZONE != "":
-        app_timezone = pytz.timezone(settings.EVENT_TIME_ZONE)
-    else:
-        app_timezone = timezone.get_default_timezone()
-    dates = Event.objects.published().values_list("start", flat=True)
-    correct_timezone_dates = [timezone.make_naive(date, app_timezone) for date in dates]
-    date_dicts = [{"date": datetime(date.year, date.month, 1)} for date in correct_timezone_dates]
-    month_dicts = []
-    for date_dict in date_dicts:
-        if date_dict not in month_dicts:
-            month_dicts.append(date_dict)
-    for i, date_dict in enumerate(month_dicts):
-        month_dicts[i]["event_count"] = date_dicts.count(date_dict)
-    return month_dicts
+    return _cached_tag(_event_months)
 
 
-@register.as_tag
-def event_locations(*args):
+def _event_locations():
     """
-    Put a list of locations for events into the template context.
+    Returns the locations of events, with a count of their events.
     """
     events = Event.objects.published()
     locations = EventLocation.objects.filter(event__in=events)
@@ -59,15 +91,37 @@ def event_locations(*args):
 
 
 @register.as_tag
-def event_authors(*args):
+def event_locations(*args):
     """
-    Put a list of authors (users) for events into the template context.
+    Put a list of locations for events into the template context.
+    """
+    return _cached_tag(_event_locations)
+
+
+def _event_authors():
+    """
+    Returns the authors of events, with a count of their events.
     """
     events = Event.objects.published()
     authors = User.objects.filter(events__in=events)
     return list(authors.annotate(event_count=Count("events")))
 
 
+@register.as_tag
+def event_authors(*args):
+    """
+    Put a list of authors (users) for events into the template context.
+    """
+    return _cached_tag(_event_authors)
+
+
+def _recent_events(limit, tag, username, location):
+    """
+    Returns the filtered events that have most recently ended.
+    """
+    return get_event_index().recent(limit, tag, username, location)
+
+
 @register.as_tag
 def recent_events(limit=5, tag=None, username=None, location=None):
     """
@@ -83,28 +137,14 @@ def recent_events(limit=5, tag=None, username=None, location=None):
         {% recent_events 5 username=admin as recent_pevents %}
 
     """
-    events = Event.objects.published().select_related("user").order_by('-start')
-    events = events.filter(end__lt=datetime.now())
-    title_or_slug = lambda s: Q(title=s) | Q(slug=s)
-    if tag is not None:
-        try:
-            tag = Keyword.objects.get(title_or_slug(tag))
-            events = events.filter(keywords__keyword=tag)
-        except Keyword.DoesNotExist:
-            return []
-    if location is not None:
-        try:
-            location = EventLocation.objects.get(title_or_slug(location))
-            events = events.filter(location=location)
-        except EventLocation.DoesNotExist:
-            return []
-    if username is not None:
-        try:
-            author = User.objects.get(username=username)
-            events = events.filter(user=author)
-        except User.DoesNotExist:
-            return []
-    return list(events[:limit])
+    return _cached_tag(_recent_events, limit, tag, username, location)
+
+
+def _upcoming_events(limit, tag, username, location):
+    """
+    Returns the filtered events that are upcoming or ongoing.
+    """
+    return get_event_index().upcoming(limit, tag, username, location)
 
 
 @register.as_tag
@@ -122,43 +162,35 @@ def upcoming_events(limit=5, tag=None, username=None, location=None):
         {% upcoming_events 5 username=admin as upcoming_events %}
 
     """
-    events = Event.objects.published().select_related("user").order_by('start')
-    #Get upcoming events/ongoing events
-    events = events.filter(Q(start__gt=datetime.now()) | Q(end__gt=datetime.now()))
-    title_or_slug = lambda s: Q(title=s) | Q(slug=s)
-    if tag is not None:
-        try:
-            tag = Keyword.objects.get(title_or_slug(tag))
-            events = events.filter(keywords__keyword=tag)
-        except Keyword.DoesNotExist:
-            return []
-    if location is not None:
-        try:
-            location = EventLocation.objects.get(title_or_slug(location))
-            events = events.filter(location=location)
-        except EventLocation.DoesNotExist:
-            return []
-    if username is not None:
-        try:
-            author = User.objects.get(username=username)
-            events = events.filter(user=author)
-        except User.DoesNotExist:
-            return []
-    return list(events[:limit])
+    return _cached_tag(_upcoming_events, limit, tag, username, location)
+
+
+@register.as_tag
+def nearby_events(lat, lon, distance=10, limit=5):
+    """
+    Put a list of upcoming events within a distance in kilometres of
+    a point into the template context, nearest first, with the
+    distance to each event set as ``distance``.
+
+    Usage::
+
+        {% nearby_events -34.93 138.6 as nearby_events %}
+        {% nearby_events location.lat location.lon distance=25 as nearby_events %}
+
+    """
+    try:
+        return get_nearby_events(lat, lon, distance, limit)
+    except (TypeError, ValueError):
+        return []
 
 
 def _get_utc(datetime):
     """
     Convert datetime object to be timezone aware and in UTC.
     """
-    if settings.EVENT_TIME_ZONE != "":
-        app_timezone = pytz.timezone(settings.EVENT_TIME_ZONE)
-    else:
-        app_timezone = timezone.get_default_timezone()
-
     # make the datetime aware
     if timezone.is_naive(datetime):
-        datetime = timezone.make_aware(datetime, app_timezone)
+        datetime = timezone.make_aware(datetime, get_event_timezone())
 
     # now, make it UTC
     datetime = timezone.make_naive(datetime, timezone.utc)
@@ -179,7 +211,7 @@ def google_calendar_url(event):
         end_date = _get_utc(event.end).strftime("%Y%m%dT%H%M%SZ")
     else:
         end_date = start_date
-    url = Site.objects.get(id=current_site_id()).domain + event.get_absolute_url()
+    url = get_site_domain(event.site_id) + event.get_absolute_url()
     if event.location:
         location = quote(event.location.mappable_location)
     else:
@@ -222,6 +254,30 @@ def google_interactive_map(event, width, height, zoom, map_type='roadmap'):
     return mark_safe('<iframe width="{width}" height="{height}" frameborder="0" style="border:0" src="https://www.google.com/maps/embed/v1/place?q={location}&zoom={zoom}&center={center}&maptype={map_type}&key={api_key}" allowfullscreen></iframe>'.format(**locals()))
 
 
+@register.inclusion_tag("agenda/includes/cursor_pagination.html",
+                        takes_context=True)
+def cursor_pagination_for(context, current_page, cursor_var="cursor",
+                          exclude_vars=""):
+    """
+    Include the pagination template and data for persisting querystring
+    in pagination links, for a page of events paginated by cursor.
+    Can also contain a comma separated string of var names in the
+    current querystring to exclude from the pagination links, via the
+    ``exclude_vars`` arg.
+    """
+    querystring = context["request"].GET.copy()
+    exclude_vars = [v for v in exclude_vars.split(",") if v] + [cursor_var]
+    for exclude_var in exclude_vars:
+        if exclude_var in querystring:
+            del querystring[exclude_var]
+    querystring = querystring.urlencode()
+    return {
+        "current_page": current_page,
+        "querystring": querystring,
+        "cursor_var": cursor_var,
+    }
+
+
 @register.simple_tag(takes_context=True)
 def icalendar_url(context):
     """
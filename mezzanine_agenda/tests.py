@@ -6,15 +6,42 @@ except ImportError:
     from urlparse import urlparse
 
 from datetime import datetime, timedelta
+import io
+import json
+import os
+import sqlite3
+import tempfile
+from time import time
+from xml.dom.minidom import parseString
 
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.template import Context, Template
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
 from django.utils.unittest import skipUnless
 
-from mezzanine_agenda.models import Event, EventLocation
+from mezzanine_agenda.autocomplete import get_autocomplete_index
+from mezzanine_agenda.geocoders import GazetteerGeocoder
+from mezzanine_agenda.index import get_event_index
+from mezzanine_agenda.models import (Event, EventLocation, GeocodeJob,
+                                     GeocodeResult)
+from mezzanine_agenda.proximity import get_nearby_events, haversine
+from mezzanine_agenda.recurrence import filter_occurring, from_local
+from mezzanine_agenda.search import search_events
+from mezzanine_agenda.utils import (CACHE_CHANGED_KEY, get_cache_version,
+                                    paginate_by_cursor)
 from mezzanine.conf import settings
 
 from mezzanine.core.models import CONTENT_STATUS_DRAFT, CONTENT_STATUS_PUBLISHED
+from mezzanine.core.request import _thread_local
+from mezzanine.generic.models import Keyword
 from mezzanine.pages.models import RichTextPage
+from mezzanine.utils.sites import current_site_id
 from mezzanine.utils.tests import TestCase
 
 from datetime import datetime
@@ -103,13 +130,29 @@ class EventTests(TestCase):
 
     def test_clean(self):
         """
-        Test the events geocoding functionality.
+        Test the events geocoding functionality, offline from a
+        gazetteer.
         """
-        self.eventlocation.clean()
+        handle, path = tempfile.mkstemp(suffix=".csv")
+        os.close(handle)
+        with io.open(path, "w", encoding="utf-8") as f:
+            f.write("\"1 Susan St, Hindmarsh, South Australia\","
+                    "\"1 Susan Street, Hindmarsh SA 5007, Australia\","
+                    "-34.907924,138.567624\n"
+                    "\u30b5\u30f3\u30b7\u30e3\u30a4\u30f360,"
+                    "\"Sunshine 60, Higashiikebukuro, Toshima, Tokyo, Japan\","
+                    "35.729534,139.718055\n")
+        try:
+            with override_settings(
+                    EVENT_GEOCODER="mezzanine_agenda.geocoders.GazetteerGeocoder",
+                    EVENT_GAZETTEER=path):
+                self.eventlocation.clean()
+                self.unicode_eventlocation.clean()
+        finally:
+            os.remove(path)
         self.assertAlmostEqual(self.eventlocation.lat, -34.907924, places=5)
         self.assertAlmostEqual(self.eventlocation.lon, 138.567624, places=5)
         self.assertEqual(self.eventlocation.mappable_location, '1 Susan Street, Hindmarsh SA 5007, Australia')
-        self.unicode_eventlocation.clean()
         self.assertAlmostEqual(self.unicode_eventlocation.lat, 35.729534, places=5)
         self.assertAlmostEqual(self.unicode_eventlocation.lon, 139.718055, places=5)
 
@@ -124,3 +167,752 @@ class EventTests(TestCase):
         response = self.client.get(reverse("icalendar"))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response['Content-Type'], 'text/calendar')
+
+    def test_icalendar_streaming(self):
+        """
+        Test the streamed icalendar matches the one built in memory.
+        """
+        response = self.client.get(reverse("icalendar"))
+        with override_settings(EVENT_ICAL_STREAMING=True):
+            streamed = self.client.get(reverse("icalendar"))
+        self.assertTrue(streamed.streaming)
+        self.assertEqual(streamed['Content-Type'], 'text/calendar')
+        self.assertEqual(b"".join(streamed.streaming_content),
+                         response.content)
+
+    def test_icalendar_vevent(self):
+        """
+        Test the stored icalendar event is rebuilt when the event or its
+        location changes.
+        """
+        event = Event.objects.get(id=self.event.id)
+        self.assertIn("THIS IS AN EVENT THAT IS PUBLISHED",
+                      event.icalendar_vevent)
+        self.eventlocation.address = "2 Susan St"
+        self.eventlocation.save()
+        event = Event.objects.get(id=self.event.id)
+        self.assertIn("2 Susan St", event.icalendar_vevent)
+        response = self.client.get(reverse("icalendar"))
+        self.assertContains(response, "2 Susan St")
+
+    def test_icalendar_vevent_site(self):
+        """
+        Test the stored icalendar events are rebuilt when their site's
+        domain changes, or by the rebuild_icalendar command.
+        """
+        site = Site.objects.get(id=self.event.site_id)
+        site.domain = "events.example.com"
+        site.save()
+        event = Event.objects.get(id=self.event.id)
+        self.assertIn("events.example.com", event.icalendar_vevent)
+        Event.objects.filter(id=self.event.id).update(icalendar_vevent="")
+        call_command("rebuild_icalendar", verbosity=0)
+        event = Event.objects.get(id=self.event.id)
+        self.assertIn("events.example.com", event.icalendar_vevent)
+
+    def test_conditional_get(self):
+        """
+        Test the icalendar and feed views answer 304 for unchanged events.
+        """
+        urls = (reverse("icalendar"),
+                reverse("icalendar_event", args=(self.event.slug,)),
+                reverse("event_feed", args=("rss",)),
+                reverse("event_feed", args=("atom",)))
+        for url in urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response["ETag"]
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=
+                                       response["Last-Modified"])
+            self.assertEqual(response.status_code, 304)
+        etag = self.client.get(urls[0])["ETag"]
+        self.event.title = "THIS EVENT HAS CHANGED"
+        self.event.save()
+        response = self.client.get(urls[0], HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = self.client.get(urls[0])["ETag"]
+        self.eventlocation.address = "2 Susan St"
+        self.eventlocation.save()
+        response = self.client.get(urls[0], HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse("icalendar_event",
+                                           args=("missing",)),
+                                   HTTP_IF_NONE_MATCH="*")
+        self.assertEqual(response.status_code, 404)
+        # Backdate the last change, so that a change made within the
+        # same second is still later.
+        yesterday = timezone.now() - timedelta(days=1)
+        Event.objects.update(updated=yesterday)
+        cache.set(CACHE_CHANGED_KEY, time() - 60 * 60 * 24, None)
+        last_modified = self.client.get(urls[0])["Last-Modified"]
+        Event.objects.get(id=self.unicode_event.id).delete()
+        response = self.client.get(urls[0],
+                                   HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        for url_name in ("event_feed_tag", "event_feed_location",
+                         "event_feed_author"):
+            response = self.client.get(reverse(url_name,
+                                               args=("missing", "rss")),
+                                       HTTP_IF_NONE_MATCH="*")
+            self.assertEqual(response.status_code, 404)
+
+    def _render_tag(self, tag):
+        """
+        Renders an ``as`` template tag, returning the value it puts
+        into the context.
+        """
+        context = Context()
+        Template("{%% load event_tags %%}{%% %s as value %%}" %
+                 tag).render(context)
+        return context["value"]
+
+    def _clear_current_request(self):
+        """
+        Clears the request left on the thread by an earlier test's
+        client, so that the current site is ``SITE_ID`` rather than
+        looked up by the request's host on every call, and queries
+        can be counted regardless of the order tests run in.
+        """
+        _thread_local.request = None
+        current_site_id()
+
+    def test_event_months(self):
+        """
+        Test the archive months are counted for published events only.
+        """
+        months = self._render_tag("event_months")
+        self.assertEqual(len(months), 1)
+        self.assertEqual(months[0]["event_count"], len(self.events))
+        self.assertEqual(months[0]["date"].day, 1)
+
+    def _index_name(self, *columns):
+        """
+        Returns the name of the SQLite index on the event table covering
+        exactly the given columns.
+        """
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA index_list(%s)" % Event._meta.db_table)
+        for index in cursor.fetchall():
+            name = index[1]
+            cursor.execute("PRAGMA index_info(%s)" % connection.ops.quote_name(name))
+            if tuple(column[2] for column in cursor.fetchall()) == columns:
+                return name
+
+    def _query_plan(self, events):
+        """
+        Returns SQLite's query plan for the given queryset.
+        """
+        sql, params = events.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN %s" % sql, params)
+        return " ".join(str(step[-1]) for step in cursor.fetchall())
+
+    @skipUnless(connection.vendor == "sqlite", "SQLite required")
+    def test_indexes(self):
+        """
+        Test the composite indexes are used for the events' query shapes.
+        """
+        events = Event.objects.published()
+        archive = events.filter(start__gte=datetime(2014, 1, 1),
+                                start__lt=datetime(2014, 2, 1))
+        self.assertIn(self._index_name("site_id", "status", "start"),
+                      self._query_plan(archive))
+        upcoming = events.filter(effective_end__gt=datetime.now())
+        self.assertIn(self._index_name("site_id", "status", "effective_end"),
+                      self._query_plan(upcoming))
+        by_location = events.filter(location=self.eventlocation)
+        self.assertIn(self._index_name("site_id", "status", "location_id",
+                                       "start"),
+                      self._query_plan(by_location))
+        by_author = events.filter(user=self._user)
+        self.assertIn(self._index_name("site_id", "status", "user_id",
+                                       "start"),
+                      self._query_plan(by_author))
+
+    def test_effective_end(self):
+        """
+        Test the effective end falls back to the start for events
+        without an end.
+        """
+        self.assertEqual(self.event.effective_end, self.event.end)
+        event = Event.objects.create(title="Event", start=datetime.now(),
+                                     user=self._user)
+        self.assertEqual(event.effective_end, event.start)
+
+    def test_archive(self):
+        """
+        Test the archive views match the months listed in the sidebar.
+        """
+        for month in self._render_tag("event_months"):
+            date = month["date"]
+            args = (date.year, date.month)
+            response = self.client.get(reverse("event_list_month", args=args))
+            self.assertContains(response, self.event.title)
+            response = self.client.get(reverse("icalendar_month", args=args))
+            self.assertEqual(response.content.count(b"BEGIN:VEVENT"),
+                             month["event_count"])
+        response = self.client.get(reverse("event_list_month",
+                                           args=(2014, 13)))
+        self.assertEqual(response.status_code, 404)
+        # Daylight saving starts at midnight on the 1st in Asuncion.
+        with override_settings(EVENT_TIME_ZONE="America/Asuncion"):
+            response = self.client.get(reverse("event_list_month",
+                                               args=(2017, 10)))
+        self.assertEqual(response.status_code, 200)
+
+    def test_cursor_pagination(self):
+        """
+        Test paging forwards and backwards through events by cursor.
+        """
+        for i in range(7):
+            Event.objects.create(title="Event %s" % i, user=self._user,
+                                 start=datetime(2014, 1, 1 + i // 2))
+        events = Event.objects.all()
+        expected = list(events.order_by("-start", "-id"))
+        pages = [paginate_by_cursor(events, None, 3, descending=True)]
+        self.assertFalse(pages[0].has_previous())
+        while pages[-1].has_next():
+            pages.append(paginate_by_cursor(events, pages[-1].next_cursor,
+                                            3, descending=True))
+        self.assertEqual([e for page in pages for e in page], expected)
+        page = pages[-1]
+        for previous_page in reversed(pages[:-1]):
+            page = paginate_by_cursor(events, page.previous_cursor, 3,
+                                      descending=True)
+            self.assertEqual(page.object_list, previous_page.object_list)
+        self.assertFalse(page.has_previous())
+        self.assertEqual(len(paginate_by_cursor(events, "bad", 3)), 3)
+        with override_settings(EVENT_CURSOR_PAGINATION=True):
+            response = self.client.get(reverse("event_list"))
+        self.assertContains(response, self.event.title)
+
+    def test_geocode_cache(self):
+        """
+        Test geocoding uses cached results, including locations that
+        couldn't be found, and ignores expired results.
+        """
+        domain = settings.EVENT_GOOGLE_MAPS_DOMAIN
+        location = EventLocation(address="Cached  Street\nAdelaide")
+        GeocodeResult.objects.store("cached street, adelaide", domain,
+                                    "Cached Street, Adelaide", 1, 2)
+        location.clean()
+        self.assertEqual(location.mappable_location, "Cached Street, Adelaide")
+        self.assertEqual((location.lat, location.lon), (1, 2))
+        location = EventLocation(address="Nowhere")
+        GeocodeResult.objects.store("Nowhere", domain, error="Not found")
+        self.assertRaises(ValidationError, location.clean)
+        with override_settings(EVENT_GEOCODE_NEGATIVE_CACHE_TTL=-1):
+            self.assertEqual(GeocodeResult.objects.lookup("Nowhere", domain),
+                             None)
+
+    def test_gazetteer_geocoder(self):
+        """
+        Test geocoding offline from CSV and SQLite gazetteers.
+        """
+        rows = [("1 Susan St, Hindmarsh, South Australia",
+                 "1 Susan Street, Hindmarsh SA 5007, Australia",
+                 -34.907924, 138.567624)]
+        handle, csv_path = tempfile.mkstemp(suffix=".csv")
+        with os.fdopen(handle, "w") as f:
+            f.write("\n".join(",".join('"%s"' % cell for cell in row)
+                              for row in rows))
+        handle, db_path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        connection = sqlite3.connect(db_path)
+        connection.execute("CREATE TABLE gazetteer "
+                           "(location TEXT, address TEXT, lat REAL, lon REAL)")
+        connection.execute("INSERT INTO gazetteer VALUES (?, ?, ?, ?)",
+                           (rows[0][0].lower(),) + rows[0][1:])
+        connection.commit()
+        connection.close()
+        geocoder = "mezzanine_agenda.geocoders.GazetteerGeocoder"
+        # Results cached for other geocoders aren't used.
+        GeocodeResult.objects.store(rows[0][0],
+            settings.EVENT_GOOGLE_MAPS_DOMAIN, "Elsewhere", 1, 2)
+        try:
+            for path in (csv_path, db_path):
+                self.assertEqual(GazetteerGeocoder(path).geocode(rows[0][0]),
+                                 (rows[0][1], rows[0][2:]))
+            location = EventLocation(address=self.eventlocation.address)
+            with override_settings(EVENT_GEOCODER=geocoder,
+                                   EVENT_GAZETTEER=csv_path):
+                location.clean()
+                self.assertAlmostEqual(location.lat, -34.907924, places=5)
+                self.assertAlmostEqual(location.lon, 138.567624, places=5)
+                self.assertEqual(location.mappable_location, rows[0][1])
+                location = EventLocation(address="Nowhere")
+                self.assertRaises(ValidationError, location.clean)
+        finally:
+            os.remove(csv_path)
+            os.remove(db_path)
+
+    def test_geocode_async(self):
+        """
+        Test locations are queued for geocoding when saved and geocoded
+        by the worker.
+        """
+        handle, path = tempfile.mkstemp(suffix=".csv")
+        with os.fdopen(handle, "w") as f:
+            f.write("Queued Street,\"Queued Street, Adelaide\",1.5,2.5\n")
+        try:
+            with override_settings(EVENT_GEOCODE_ASYNC=True,
+                    EVENT_GEOCODER="mezzanine_agenda.geocoders.GazetteerGeocoder",
+                    EVENT_GAZETTEER=path):
+                location = EventLocation(title="Queued",
+                                         address="Queued Street")
+                location.clean()
+                location.save()
+                self.assertEqual(location.lat, None)
+                self.assertEqual(GeocodeJob.objects.filter(
+                    location=location, completed__isnull=True).count(), 1)
+                call_command("geocode_worker", once=True, verbosity=0)
+        finally:
+            os.remove(path)
+        location = EventLocation.objects.get(id=location.id)
+        self.assertEqual(location.mappable_location, "Queued Street, Adelaide")
+        self.assertAlmostEqual(location.lat, 1.5)
+        self.assertAlmostEqual(location.lon, 2.5)
+        self.assertFalse(GeocodeJob.objects.filter(
+            completed__isnull=True).exists())
+
+    def test_geocode_locations(self):
+        """
+        Test bulk geocoding of locations missing coordinates.
+        """
+        handle, path = tempfile.mkstemp(suffix=".csv")
+        with os.fdopen(handle, "w") as f:
+            f.write("\"1 Susan St, Hindmarsh, South Australia\","
+                    "\"1 Susan Street, Hindmarsh SA 5007, Australia\","
+                    "-34.907924,138.567624\n")
+        hand_set = EventLocation.objects.create(title="Hand set",
+            address="1 Susan St\nHindmarsh\nSouth Australia", lat=1, lon=2)
+        version = get_cache_version()
+        try:
+            with override_settings(
+                    EVENT_GEOCODER="mezzanine_agenda.geocoders.GazetteerGeocoder",
+                    EVENT_GAZETTEER=path):
+                call_command("geocode_locations", workers=2, rate=0,
+                             retries=0, verbosity=0)
+        finally:
+            os.remove(path)
+        self.assertNotEqual(get_cache_version(), version)
+        location = EventLocation.objects.get(id=self.eventlocation.id)
+        self.assertAlmostEqual(float(location.lat), -34.907924, places=5)
+        self.assertAlmostEqual(float(location.lon), 138.567624, places=5)
+        location = EventLocation.objects.get(id=hand_set.id)
+        self.assertEqual((location.lat, location.lon), (1, 2))
+        self.assertEqual(location.mappable_location, "")
+        location = EventLocation.objects.get(id=self.unicode_eventlocation.id)
+        self.assertEqual(location.lat, None)
+
+    def test_sidebar_cache(self):
+        """
+        Test the sidebar's tags are cached until events change.
+        """
+        self._clear_current_request()
+        upcoming = self._render_tag("upcoming_events 5")
+        with self.assertNumQueries(0):
+            self.assertEqual(self._render_tag("upcoming_events 5"), upcoming)
+        event = Event.objects.create(title="Event", user=self._user,
+            start=datetime.now() + timedelta(days=1),
+            status=CONTENT_STATUS_PUBLISHED)
+        self.assertIn(event, self._render_tag("upcoming_events 5"))
+        event.delete()
+        self.assertNotIn(event, self._render_tag("upcoming_events 5"))
+
+    def test_event_index(self):
+        """
+        Test the event index answers upcoming and recent events with a
+        single query once built, and is rebuilt when events change.
+        """
+        now = datetime.now()
+        ended = Event.objects.create(title="Ended", user=self._user,
+            start=now - timedelta(days=2), end=now - timedelta(days=1),
+            location=self.eventlocation)
+        long_event = Event.objects.create(title="Long", user=self._user,
+            start=now - timedelta(days=30), end=now + timedelta(days=30))
+        ended.keywords.create(keyword=Keyword.objects.create(title="past"))
+        index = get_event_index()
+        with self.assertNumQueries(1):
+            upcoming = index.upcoming(5)
+        self.assertEqual(upcoming, list(Event.objects.published().filter(
+            effective_end__gt=now).order_by("start")))
+        self.assertIn(long_event, upcoming)
+        with self.assertNumQueries(1):
+            self.assertEqual(index.recent(5, tag="past"), [ended])
+        self.assertEqual(index.recent(5, location=self.eventlocation.slug),
+                         [ended])
+        self.assertEqual(index.recent(5, username="unknown"), [])
+        self.assertEqual(index.upcoming(5, username=self._user.username),
+                         upcoming)
+        ended.status = CONTENT_STATUS_DRAFT
+        ended.save()
+        self.assertEqual(get_event_index().recent(5), [])
+
+    def test_recurring_events(self):
+        """
+        Test recurring events are expanded into their occurrences, and
+        are found by upcoming events and the month archive.
+        """
+        start = timezone.now().replace(microsecond=0) - timedelta(days=60)
+        skipped = timezone.localtime(start + timedelta(days=7))
+        event = Event.objects.create(title="Weekly", user=self._user,
+            start=start, end=start + timedelta(hours=1),
+            rrule="FREQ=WEEKLY;COUNT=4", exdate=skipped.strftime("%Y-%m-%d"))
+        occurrences = list(event.get_occurrences())
+        self.assertEqual(len(occurrences), 3)
+        self.assertEqual(event.effective_end, occurrences[-1][1])
+        self.assertEqual(len(list(event.get_occurrences(
+            after=start + timedelta(days=10),
+            before=start + timedelta(days=20)))), 1)
+        self.assertIn("RRULE:FREQ=WEEKLY;COUNT=4", event.icalendar_vevent)
+        self.assertIn("EXDATE", event.icalendar_vevent)
+        series = Event.objects.create(title="EVERY DAY", user=self._user,
+                                      start=start, rrule="RRULE:FREQ=DAILY")
+        self.assertEqual(series.effective_end.year, 9999)
+        upcoming = self._render_tag("upcoming_events 5")
+        self.assertIn(series, upcoming)
+        self.assertNotIn(event, upcoming)
+        month = timezone.localtime(start + timedelta(days=55))
+        response = self.client.get(reverse("event_list_month",
+                                           args=(month.year, month.month)))
+        self.assertIn(series, response.context["events"])
+        self.assertNotIn(event, response.context["events"])
+        self.assertRaises(ValidationError, Event(title="Event", start=start,
+                          rrule="FREQ=SOMETIMES").clean)
+
+    def test_icalendar_timezone(self):
+        """
+        Test recurring events are written in the timezone they recur in,
+        which is described by the calendar, so that calendar clients
+        keep their time of day across daylight saving changes.
+        """
+        with override_settings(EVENT_TIME_ZONE="Australia/Adelaide"):
+            event = Event.objects.create(title="Weekly", user=self._user,
+                start=from_local(datetime(2014, 3, 30, 10)),
+                end=from_local(datetime(2014, 3, 30, 11)),
+                rrule="FREQ=WEEKLY;COUNT=3", exdate="2014-04-06")
+            lines = dict(line.split(":", 1)[0].split(";")[0:1] +
+                         [line] for line in event.icalendar_vevent.splitlines())
+            for name, time in (("DTSTART", "20140330T100000"),
+                               ("DTEND", "20140330T110000"),
+                               ("EXDATE", "20140406T100000")):
+                self.assertIn("TZID=Australia/Adelaide", lines[name])
+                self.assertTrue(lines[name].endswith(":" + time))
+            response = self.client.get(reverse("icalendar_event",
+                                               args=(event.slug,)))
+        self.assertContains(response, "BEGIN:VTIMEZONE")
+        self.assertContains(response, "TZID:Australia/Adelaide")
+        self.assertContains(response, "TZOFFSETFROM:+1030\r\n"
+                                      "TZOFFSETTO:+0930")
+        event = Event.objects.get(id=event.id)
+        event.save()
+        self.assertNotIn("Australia/Adelaide", event.icalendar_vevent)
+
+    def test_event_occurrences(self):
+        """
+        Test occurrences are stored up to the horizon, updated when the
+        recurrence rule changes, and extended by the management command.
+        """
+        now = timezone.now().replace(microsecond=0)
+        with override_settings(EVENT_OCCURRENCE_HORIZON_DAYS=30):
+            event = Event.objects.create(title="Weekly", user=self._user,
+                start=now - timedelta(days=7), rrule="FREQ=WEEKLY")
+        starts = list(event.occurrences.values_list("start", flat=True))
+        self.assertTrue(now + timedelta(days=23) < starts[-1] <
+                        now + timedelta(days=30))
+        self.assertEqual(event.occurrences_until.date(),
+                         (now + timedelta(days=30)).date())
+        self.assertIn(event, filter_occurring(Event.objects.all(),
+            now + timedelta(days=34), now + timedelta(days=41)))
+        first = event.occurrences.all()[0]
+        call_command("extend_occurrences", days=60, verbosity=0)
+        self.assertTrue(Event.objects.get(id=event.id).occurrences_until >
+                        now + timedelta(days=59))
+        starts = list(event.occurrences.values_list("start", flat=True))
+        self.assertEqual(len(starts), len(set(starts)))
+        self.assertTrue(now + timedelta(days=53) < starts[-1] <
+                        now + timedelta(days=60))
+        event.rrule = "FREQ=WEEKLY;COUNT=3"
+        event.save()
+        self.assertEqual(event.occurrences.count(), 3)
+        self.assertEqual(event.occurrences.all()[0].id, first.id)
+        self.assertFalse(event.occurrences.filter(start__gt=starts[2]).exists())
+        with override_settings(EVENT_OCCURRENCE_HORIZON_DAYS=30):
+            later = Event.objects.create(title="Later", user=self._user,
+                start=now + timedelta(days=45))
+        self.assertFalse(later.occurrences.exists())
+        found = filter_occurring(Event.objects.all(),
+            now + timedelta(days=44), now + timedelta(days=46))
+        self.assertEqual(list(found), [later])
+
+    def test_event_calendar(self):
+        """
+        Test the calendar views spread events over each day they span.
+        """
+        Event.objects.create(title="Long", user=self._user,
+                             start=from_local(datetime(2014, 1, 30, 20)),
+                             end=from_local(datetime(2014, 2, 2)))
+        Event.objects.create(title="Daily", user=self._user,
+                             start=from_local(datetime(2014, 1, 10, 9)),
+                             rrule="FREQ=DAILY;COUNT=3")
+
+        def get_days(url_name, *args):
+            response = self.client.get(reverse(url_name, args=args))
+            calendar = json.loads(response.content.decode("utf-8"))
+            return calendar, dict((title, [day["date"]
+                for day in calendar["days"] if title in
+                [event["title"] for event in day["events"]]])
+                for title in ("Long", "Daily"))
+
+        calendar, days = get_days("event_calendar_month_json", 2014, 1)
+        self.assertEqual(calendar["start"], "2013-12-30")
+        self.assertEqual(calendar["end"], "2014-02-02")
+        self.assertEqual(days["Long"], ["2014-01-30", "2014-01-31",
+                                        "2014-02-01"])
+        self.assertEqual(days["Daily"], ["2014-01-10", "2014-01-11",
+                                         "2014-01-12"])
+        calendar, days = get_days("event_calendar_week_json", 2014, 5)
+        self.assertEqual(len(calendar["days"]), 7)
+        self.assertEqual(len(days["Long"]), 3)
+        calendar, days = get_days("event_calendar_day_json", 2014, 2, 2)
+        self.assertEqual(days["Long"], [])
+        response = self.client.get(reverse("event_calendar_month",
+                                           args=(2014, 1)))
+        self.assertContains(response, "Daily")
+        response = self.client.get(reverse("event_calendar_week",
+                                           args=(2014, 53)))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get(reverse("event_calendar")).status_code,
+                         200)
+
+    def test_nearby_events(self):
+        """
+        Test events are found within a distance of a point, nearest first.
+        """
+        start = timezone.now() + timedelta(days=1)
+        events = []
+        for title, lat, lon in (("Hindmarsh", -34.9069, 138.5687),
+                                ("Adelaide", -34.9285, 138.6007),
+                                ("Melbourne", -37.8136, 144.9631)):
+            location = EventLocation.objects.create(title=title, address=title,
+                mappable_location=title, lat=lat, lon=lon)
+            events.append(Event.objects.create(title=title, user=self._user,
+                                               start=start, location=location))
+        self.assertAlmostEqual(haversine(-34.9285, 138.6007,
+                                         -37.8136, 144.9631), 654, delta=1)
+        nearby = get_nearby_events(-34.93, 138.6, 10)
+        self.assertEqual(nearby, [events[1], events[0]])
+        self.assertTrue(nearby[0].distance < nearby[1].distance < 10)
+        response = self.client.get(reverse("event_nearby"),
+            {"lat": -34.93, "lon": 138.6, "distance": 1000, "limit": 2})
+        data = json.loads(response.content.decode("utf-8"))
+        self.assertEqual([event["title"] for event in data],
+                         ["Adelaide", "Hindmarsh"])
+        response = self.client.get(reverse("event_nearby"), {"lat": "x"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(get_nearby_events(-34.93, -179.99, 10), [])
+        EventLocation.objects.bulk_create([EventLocation(
+            site_id=current_site_id(), title="Venue %s" % i,
+            slug="venue-%s" % i, address="Venue",
+            mappable_location="Venue", lat=-34.93, lon=138.6 + i * 1e-5)
+            for i in range(1000)])
+        self._clear_current_request()
+        with self.assertNumQueries(4):
+            nearby = get_nearby_events(-34.93, 138.6, 10, limit=2)
+        self.assertEqual(nearby, [events[1], events[0]])
+        self.assertEqual(len(get_nearby_events(-34.93, 138.6, 10)), 2)
+
+    def test_search(self):
+        """
+        Test searching events ranks title matches first, pages through
+        results, and follows changes to events and their locations.
+        """
+        location = EventLocation.objects.create(title="Town Hall",
+                                                address="1 Jazz Street")
+        in_title = Event.objects.create(title="Jazz night", user=self._user,
+                                        start=datetime.now())
+        in_content = Event.objects.create(title="Music", user=self._user,
+            start=datetime.now(), content="<p>Jazz and blues</p>")
+        in_location = Event.objects.create(title="Concert", user=self._user,
+                                           start=datetime.now())
+        in_location.location = location
+        in_location.save()
+        Event.objects.create(title="Jazz draft", user=self._user,
+            start=datetime.now(), status=CONTENT_STATUS_DRAFT)
+        page = search_events("jazz", per_page=2)
+        self.assertEqual(page.object_list[0], in_title)
+        self.assertTrue(page.has_next())
+        next_page = search_events("jazz", page.next_cursor, per_page=2)
+        self.assertFalse(next_page.has_next())
+        self.assertEqual(set(page.object_list + next_page.object_list),
+                         set([in_title, in_content, in_location]))
+        location.address = "1 Blues Street"
+        location.save()
+        self.assertEqual(search_events("jazz").object_list,
+                         [in_title, in_content])
+        in_title.delete()
+        self.assertEqual(search_events("jazz").object_list, [in_content])
+        response = self.client.get(reverse("event_search_json"),
+                                   {"q": "jazz"})
+        data = json.loads(response.content.decode("utf-8"))
+        self.assertEqual([event["title"] for event in data["results"]],
+                         ["Music"])
+        response = self.client.get(reverse("event_search"), {"q": "blues"})
+        self.assertContains(response, "Concert")
+
+    def test_autocomplete(self):
+        """
+        Test suggestions come from the in-memory index without queries,
+        and follow changes to events in place.
+        """
+        EventLocation.objects.create(title="Jazz Hall", address="Hall")
+        event = Event.objects.create(title="Late Jazz Night", user=self._user,
+                                     start=datetime.now())
+        Event.objects.create(title="Jazz draft", user=self._user,
+            start=datetime.now(), status=CONTENT_STATUS_DRAFT)
+        suggest = lambda query: [suggestion["title"] for suggestion in
+                                 get_autocomplete_index().suggest(query)]
+        self._clear_current_request()
+        suggest("jazz")
+        with self.assertNumQueries(0):
+            self.assertEqual(sorted(suggest("jaz")),
+                             ["Jazz Hall", "Late Jazz Night"])
+            self.assertEqual(suggest("jazz ni"), ["Late Jazz Night"])
+        event.title = "Late Blues Night"
+        event.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(suggest("blu"), ["Late Blues Night"])
+            self.assertEqual(suggest("jazz n"), [])
+        event.delete()
+        self.assertEqual(suggest("blu"), [])
+        response = self.client.get(reverse("event_autocomplete"),
+                                   {"q": "jazz h"})
+        suggestions = json.loads(response.content.decode("utf-8"))
+        self.assertEqual([(s["type"], s["title"]) for s in suggestions],
+                         [("location", "Jazz Hall")])
+
+    def test_event_list_queries(self):
+        """
+        Test the number of queries for a page of events doesn't grow
+        with the number of events on it.
+        """
+        def create_event(title):
+            location = EventLocation.objects.create(title=title,
+                                                    address=title)
+            event = Event.objects.create(title=title, user=self._user,
+                start=datetime.now() + timedelta(days=1), location=location)
+            keyword = Keyword.objects.create(title="%s keyword" % title)
+            event.keywords.create(keyword=keyword)
+
+        url = reverse("event_list")
+        self.client.get(url)
+        create_event("First listed event")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertContains(response, "First listed event keyword")
+        create_event("Second listed event")
+        create_event("Third listed event")
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(url)
+        self.assertContains(response, "Third listed event keyword")
+
+    def test_event_urls(self):
+        """
+        Test event URLs built from the reversed URL pattern match those
+        given by reversing each event's URL.
+        """
+        event = Event.objects.create(title="Event URL", user=self._user,
+            slug="event url/\u30b5\u30f3", start=datetime.now(),
+            publish_date=datetime(2014, 3, 7, 12))
+        kwargs = {"slug": event.slug}
+        for date_format in ("", "year", "month", "day"):
+            url_name = "event_detail"
+            if date_format:
+                url_name = "event_detail_%s" % date_format
+                kwargs[date_format] = {"year": "2014", "month": "03",
+                                       "day": "07"}[date_format]
+            with override_settings(EVENT_URLS_DATE_FORMAT=date_format):
+                self.assertEqual(event.get_absolute_url(),
+                                 reverse(url_name, kwargs=kwargs))
+        site = Site.objects.get(id=current_site_id())
+        url = "http://%s%s" % (site.domain, event.get_absolute_url())
+        self.assertEqual(event.get_icalendar_event()["url"], url)
+
+    def test_feed_cache(self):
+        """
+        Test cached feeds are rebuilt when events or the events page change.
+        """
+        url = reverse("event_feed", args=("rss",))
+        self.assertContains(self.client.get(url), self.event.title)
+        self.event_page.title = "CHANGED EVENTS PAGE"
+        self.event_page.save()
+        self.assertContains(self.client.get(url), self.event_page.title)
+        self.event.title = "CHANGED EVENT"
+        self.event.save()
+        self.assertContains(self.client.get(url), self.event.title)
+        self.assertContains(self.client.get(url, HTTP_HOST="alias.example.com"),
+                            "http://alias.example.com/")
+        self.assertContains(self.client.get(url, secure=True),
+                            "https://testserver/")
+
+    def test_feed_history(self):
+        """
+        Test feeds link to their pages and monthly archives.
+        """
+        for month in (1, 1, 3):
+            Event.objects.create(title="Archived %s" % month, user=self._user,
+                                 start=datetime(2014, month, 10))
+
+        def get_links(url):
+            feed = parseString(self.client.get(url).content)
+            links = feed.getElementsByTagName("atom:link")
+            links = dict((link.getAttribute("rel"), link.getAttribute("href"))
+                         for link in links if link.getAttribute("rel") != "self")
+            archive = bool(feed.getElementsByTagName("fh:archive"))
+            return links, archive
+
+        def archive_url(year, month):
+            return "http://testserver%s" % reverse("event_feed_archive",
+                                                   args=("rss", year, month))
+
+        with override_settings(EVENT_RSS_LIMIT=2):
+            links, archive = get_links(reverse("event_feed", args=("rss",)))
+            self.assertFalse(archive)
+            self.assertEqual(links["prev-archive"], archive_url(2014, 3))
+            self.assertTrue(links["next"].endswith("?page=2"))
+            self.assertTrue(links["last"].endswith("?page=3"))
+            self.assertNotIn("previous", links)
+            links, archive = get_links(reverse("event_feed", args=("rss",)) +
+                                       "?page=3")
+            self.assertTrue(links["previous"].endswith("?page=2"))
+            self.assertNotIn("next", links)
+            self.assertNotIn("prev-archive", links)
+        links, archive = get_links(archive_url(2014, 1))
+        self.assertTrue(archive)
+        self.assertEqual(links["next-archive"], archive_url(2014, 3))
+        self.assertNotIn("prev-archive", links)
+        links, archive = get_links(archive_url(2014, 3))
+        self.assertEqual(links["prev-archive"], archive_url(2014, 1))
+        self.assertNotIn("next-archive", links)
+        response = self.client.get(archive_url(2014, 1))
+        self.assertEqual(response.content.count(b"<item>"), 2)
+        self.assertIn("max-age", response["Cache-Control"])
+        response = self.client.get(reverse("event_feed", args=("rss",)) +
+                                   "?page=x")
+        self.assertEqual(response.status_code, 404)
+
+    def test_feed_streaming(self):
+        """
+        Test feeds of every event are streamed in chunks.
+        """
+        for format, item in (("rss", "item"), ("atom", "entry")):
+            with override_settings(EVENT_RSS_LIMIT=None):
+                response = self.client.get(reverse("event_feed",
+                                                   args=(format,)))
+                self.assertTrue(response.streaming)
+                feed = parseString(b"".join(response.streaming_content))
+            self.assertEqual(len(feed.getElementsByTagName(item)),
+                             len(self.events))
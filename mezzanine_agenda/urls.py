@@ -10,6 +10,9 @@ _slash = "/" if settings.APPEND_SLASH else ""
 
 # Agenda patterns.
 urlpatterns = patterns("mezzanine_agenda.views",
+    url("^feeds/(?P<format>[^/]+)/archive/(?P<year>\d{4})/"
+        "(?P<month>\d{1,2})%s$" % _slash,
+        "event_feed", name="event_feed_archive"),
     url("^feeds/(?P<format>.*)%s$" % _slash,
         "event_feed", name="event_feed"),
     url("^tag/(?P<tag>.*)/feeds/(?P<format>.*)%s$" % _slash,
@@ -38,6 +41,30 @@ urlpatterns = patterns("mezzanine_agenda.views",
         "event_list", name="event_list_year"),
     url("^archive/(?P<year>\d{4})/calendar.ics$",
         "icalendar", name="icalendar_year"),
+    url("^nearby\.json$", "event_nearby", name="event_nearby"),
+    url("^autocomplete\.json$", "event_autocomplete",
+        name="event_autocomplete"),
+    url("^search%s$" % _slash, "event_search", name="event_search"),
+    url("^search\.json$", "event_search", {"format": "json"},
+        name="event_search_json"),
+    url("^calendar%s$" % _slash, "event_calendar", name="event_calendar"),
+    url("^calendar\.json$", "event_calendar", {"format": "json"},
+        name="event_calendar_json"),
+    url("^calendar/(?P<year>\d{4})/(?P<month>\d{1,2})%s$" % _slash,
+        "event_calendar", name="event_calendar_month"),
+    url("^calendar/(?P<year>\d{4})/(?P<month>\d{1,2})\.json$",
+        "event_calendar", {"format": "json"},
+        name="event_calendar_month_json"),
+    url("^calendar/(?P<year>\d{4})/week/(?P<week>\d{1,2})%s$" % _slash,
+        "event_calendar", name="event_calendar_week"),
+    url("^calendar/(?P<year>\d{4})/week/(?P<week>\d{1,2})\.json$",
+        "event_calendar", {"format": "json"},
+        name="event_calendar_week_json"),
+    url("^calendar/(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2})%s$"
+        % _slash, "event_calendar", name="event_calendar_day"),
+    url("^calendar/(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2})"
+        "\.json$", "event_calendar", {"format": "json"},
+        name="event_calendar_day_json"),
     url("^(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2})/"
         "(?P<slug>.*)%s$" % _slash,
         "event_detail", name="event_detail_day"),
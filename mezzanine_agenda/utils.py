@@ -0,0 +1,274 @@
+"""
+Utilities shared by the views, feeds and template tags of the
+``mezzanine_agenda`` app.
+"""
+from __future__ import unicode_literals
+from future.builtins import int
+
+from datetime import datetime
+from time import time
+
+from django.contrib.sites.models import Site
+from django.core import signing
+from django.core.cache import cache
+from django.core.urlresolvers import get_script_prefix, get_urlconf, reverse
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import RFC3986_SUBDELIMS, urlquote
+
+from mezzanine.conf import settings
+from mezzanine.core.request import current_request
+from mezzanine.utils.sites import current_site_id
+
+import pytz
+
+
+CACHE_VERSION_KEY = "mezzanine_agenda.version"
+CACHE_CHANGED_KEY = "mezzanine_agenda.changed"
+
+# Stands in for an event's slug when reversing the event URL pattern.
+URL_SLUG_PLACEHOLDER = "mezzanine-agenda-slug"
+
+
+def get_cache_version():
+    """
+    Returns the agenda's cache version, which is included in the keys
+    of cached content built from events, so that bumping the version
+    invalidates all of it at once.
+    """
+    version = cache.get(CACHE_VERSION_KEY)
+    if version is None:
+        # Start from the current time rather than zero, so versions
+        # used before the key was evicted aren't reused.
+        version = int(time() * 1000)
+        cache.add(CACHE_VERSION_KEY, version, None)
+        version = cache.get(CACHE_VERSION_KEY, version)
+    return version
+
+
+def bump_cache_version():
+    """
+    Invalidates cached content built from events, by changing the
+    agenda's cache version.
+    """
+    try:
+        cache.incr(CACHE_VERSION_KEY)
+    except ValueError:
+        get_cache_version()
+    cache.set(CACHE_CHANGED_KEY, time(), None)
+
+
+def get_last_changed():
+    """
+    Returns when the agenda's cache version was last bumped, or
+    ``None`` if it isn't known. Unlike the events' updated times, this
+    also changes when events are deleted, or when their locations,
+    keywords or the events page change.
+    """
+    changed = cache.get(CACHE_CHANGED_KEY)
+    if changed is None:
+        return None
+    if settings.USE_TZ:
+        return datetime.fromtimestamp(changed, timezone.utc)
+    return datetime.fromtimestamp(changed)
+
+
+def get_event_timezone():
+    """
+    Returns the timezone that event times are written in, which is
+    ``EVENT_TIME_ZONE`` if set, or otherwise the default timezone.
+    """
+    if settings.EVENT_TIME_ZONE != "":
+        return pytz.timezone(settings.EVENT_TIME_ZONE)
+    return timezone.get_default_timezone()
+
+
+def memoize_for_request(key, func):
+    """
+    Returns the result of calling ``func``, stored on the current
+    request under ``key`` so that it's only called once per request.
+    Outside of a request, ``func`` is called every time.
+    """
+    request = current_request()
+    if request is None:
+        return func()
+    try:
+        values = request._mezzanine_agenda_values
+    except AttributeError:
+        values = request._mezzanine_agenda_values = {}
+    if key not in values:
+        values[key] = func()
+    return values[key]
+
+
+def forget_for_request(key):
+    """
+    Removes a value stored on the current request by
+    ``memoize_for_request``, so that it's looked up again.
+    """
+    values = getattr(current_request(), "_mezzanine_agenda_values", None)
+    if values:
+        values.pop(key, None)
+
+
+def get_site_domain(site_id=None):
+    """
+    Returns the domain of a site, defaulting to the current site,
+    looked up once per request.
+    """
+    if site_id is None:
+        site_id = current_site_id()
+    return memoize_for_request(("domain", site_id),
+                               lambda: Site.objects.get(id=site_id).domain)
+
+
+def _get_event_url_pattern(date_format):
+    """
+    Reverses the event URL pattern for a date format once, returning
+    the parts of the URL before and after its date and slug, and the
+    date parts it contains.
+    """
+    placeholders = {"year": "0000", "month": "00", "day": "00"}
+    date_parts = ("year", "month", "day")
+    url_name = "event_detail"
+    kwargs = {"slug": URL_SLUG_PLACEHOLDER}
+    if date_format in date_parts:
+        url_name = "event_detail_%s" % date_format
+        date_parts = date_parts[:date_parts.index(date_format) + 1]
+        kwargs.update((date_part, placeholders[date_part])
+                      for date_part in date_parts)
+    else:
+        date_parts = ()
+    url = reverse(url_name, kwargs=kwargs)
+    prefix, suffix = url.rsplit(URL_SLUG_PLACEHOLDER, 1)
+    dates = "".join("%s/" % kwargs[date_part] for date_part in date_parts)
+    return prefix[:len(prefix) - len(dates)], date_parts, suffix
+
+
+def get_event_url(slug, publish_date):
+    """
+    Returns the URL of an event for the ``EVENT_URLS_DATE_FORMAT``
+    setting. The URL pattern is reversed once per request, and event
+    URLs are then built from it by formatting their slug and date, so
+    that building URLs for many events doesn't resolve each of them.
+    """
+    key = ("event_url", settings.EVENT_URLS_DATE_FORMAT, get_script_prefix(),
+           get_urlconf())
+    prefix, date_parts, suffix = memoize_for_request(key,
+        lambda: _get_event_url_pattern(settings.EVENT_URLS_DATE_FORMAT))
+    dates = "".join("%02d/" % getattr(publish_date, date_part)
+                    for date_part in date_parts)
+    # Quote the slug the same way ``reverse`` does.
+    slug = urlquote(slug, safe=RFC3986_SUBDELIMS + str("/~:@"))
+    return prefix + dates + slug + suffix
+
+
+def get_archive_range(year, month=None):
+    """
+    Returns the half-open range of datetimes covering a year, or a month
+    within it, in the timezone events are written in. Filtering with
+    ``start__gte`` and ``start__lt`` on the range can use an index on
+    ``start``, unlike ``start__year`` and ``start__month``. Raises
+    ``ValueError`` for an invalid month. Months starting at a time
+    skipped or repeated by a daylight saving change don't raise errors.
+    """
+    from mezzanine_agenda.recurrence import from_local
+    year = int(year)
+    if month is None:
+        start, end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    else:
+        month = int(month)
+        start = datetime(year, month, 1)
+        end = datetime(year + month // 12, month % 12 + 1, 1)
+    return from_local(start), from_local(end)
+
+
+class CursorPage(object):
+    """
+    A page of events returned by ``paginate_by_cursor``, with opaque
+    cursors for the next and previous pages.
+    """
+
+    cursor_paginated = True
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def _encode_cursor(event, direction):
+    """
+    Returns an opaque cursor for the page before or after an event.
+    """
+    key = [event.start.isoformat(), event.id, direction]
+    return signing.dumps(key, salt="mezzanine_agenda.cursor")
+
+
+def _decode_cursor(cursor):
+    """
+    Returns the start, id and direction stored in a cursor, or ``None``
+    if the cursor isn't valid.
+    """
+    try:
+        start, pk, direction = signing.loads(cursor,
+                                             salt="mezzanine_agenda.cursor")
+        start = parse_datetime(start)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    if start is None or direction not in ("next", "previous"):
+        return None
+    return start, pk, direction
+
+
+def paginate_by_cursor(events, cursor, per_page, descending=False):
+    """
+    Keyset pagination of events ordered by ``(start, id)``. Rather than
+    counting the events and using an offset, each page seeks past the
+    key of the last event shown, so deep pages cost the same as the
+    first. Returns a ``CursorPage``.
+    """
+    ordering = ("start", "id")
+    if descending:
+        ordering = ("-start", "-id")
+    reverse_ordering = tuple(field.lstrip("-") if field.startswith("-")
+                             else "-" + field for field in ordering)
+    key = _decode_cursor(cursor) if cursor else None
+    forward = key is None or key[2] == "next"
+    if key is not None:
+        start, pk, direction = key
+        if forward != descending:
+            events = events.filter(Q(start__gt=start) | Q(start=start,
+                                   id__gt=pk), start__gte=start)
+        else:
+            events = events.filter(Q(start__lt=start) | Q(start=start,
+                                   id__lt=pk), start__lte=start)
+    events = events.order_by(*(ordering if forward else reverse_ordering))
+    object_list = list(events[:per_page + 1])
+    more = len(object_list) > per_page
+    object_list = object_list[:per_page]
+    if not forward:
+        object_list.reverse()
+    next_cursor = previous_cursor = None
+    if object_list:
+        if more or not forward:
+            next_cursor = _encode_cursor(object_list[-1], "next")
+        if key is not None and (more or forward):
+            previous_cursor = _encode_cursor(object_list[0], "previous")
+    return CursorPage(object_list, next_cursor, previous_cursor)
@@ -1,20 +1,39 @@
 from __future__ import unicode_literals
 from future.builtins import str
 from future.builtins import int
-from calendar import month_name
+from calendar import month_name, timegm
 
-from datetime import datetime
+from datetime import date, datetime, time, timedelta
+from hashlib import md5
+import json
+from time import sleep
 
 from django.contrib.sites.models import Site
-from django.db.models import Q
-from django.http import Http404, HttpResponse
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.urlresolvers import reverse
+from django.db.models import Count, Max, Min
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+                         HttpResponseNotModified, StreamingHttpResponse)
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.cache import patch_response_headers
+from django.utils.http import (http_date, parse_etags,
+                               parse_http_date_safe, quote_etag)
+from django.utils.translation import get_language
 
 from icalendar import Calendar
 
 from mezzanine_agenda import __version__
 from mezzanine_agenda.models import Event, EventLocation
+from mezzanine_agenda.autocomplete import get_autocomplete_index
 from mezzanine_agenda.feeds import EventsRSS, EventsAtom
+from mezzanine_agenda.proximity import get_nearby_events
+from mezzanine_agenda.recurrence import (filter_occurring, from_local,
+                                         get_vtimezone, to_local)
+from mezzanine_agenda.search import search_events
+from mezzanine_agenda.utils import (get_archive_range, get_cache_version,
+                                    get_last_changed, paginate_by_cursor)
 from mezzanine.conf import settings
 from mezzanine.generic.models import Keyword
 from mezzanine.pages.models import Page
@@ -40,13 +59,13 @@ def event_list(request, tag=None, year=None, month=None, username=None,
         tag = get_object_or_404(Keyword, slug=tag)
         events = events.filter(keywords__keyword=tag)
     if year is not None:
-        events = events.filter(start__year=year)
+        try:
+            start, end = get_archive_range(year, month)
+        except ValueError:
+            raise Http404()
+        events = filter_occurring(events, start, end)
         if month is not None:
-            events = events.filter(start__month=month)
-            try:
-                month = month_name[int(month)]
-            except IndexError:
-                raise Http404()
+            month = month_name[int(month)]
     if location is not None:
         location = get_object_or_404(EventLocation, slug=location)
         events = events.filter(location=location)
@@ -57,21 +76,47 @@ def event_list(request, tag=None, year=None, month=None, username=None,
         author = get_object_or_404(User, username=username)
         events = events.filter(user=author)
         templates.append(u"agenda/event_list_%s.html" % username)
-    if not tag and not year and not location and not username:
+    upcoming = not tag and not year and not location and not username
+    if upcoming:
         #Get upcoming events/ongoing events
-        events = events.filter(Q(start__gt=datetime.now()) | Q(end__gt=datetime.now())).order_by("start")
+        start, end = timezone.now(), None
+        events = events.filter(effective_end__gt=start).order_by("start")
 
+    # Fetch everything the template shows for each event up front, so
+    # the number of queries doesn't grow with the number of events.
     prefetch = ("keywords__keyword",)
-    events = events.select_related("user").prefetch_related(*prefetch)
-    events = paginate(events, request.GET.get("page", 1),
+    events = events.select_related("user", "location")
+    events = events.prefetch_related(*prefetch)
+    if settings.EVENT_CURSOR_PAGINATION:
+        events = paginate_by_cursor(events, request.GET.get("cursor"),
+                                    settings.EVENT_PER_PAGE,
+                                    descending=not upcoming)
+    else:
+        events = paginate(events, request.GET.get("page", 1),
                           settings.EVENT_PER_PAGE,
                           settings.MAX_PAGING_LINKS)
+    if year is not None or upcoming:
+        _set_occurrences(events, start, end)
     context = {"events": events, "year": year, "month": month,
                "tag": tag, "location": location, "author": author}
     templates.append(template)
     return render(request, templates, context)
 
 
+def _set_occurrences(events, after, before):
+    """
+    Sets the start and end of the first occurrence within a range of
+    time of each recurring event, as ``occurrence_start`` and
+    ``occurrence_end``, for showing in place of the start and end of
+    the series.
+    """
+    for event in events:
+        if event.rrule:
+            for occurrence in event.get_occurrences(after, before):
+                event.occurrence_start, event.occurrence_end = occurrence
+                break
+
+
 def event_detail(request, slug, year=None, month=None, day=None,
                      template="agenda/event_detail.html"):
     """. Custom templates are checked for using the name
@@ -86,40 +131,394 @@ def event_detail(request, slug, year=None, month=None, day=None,
     return render(request, templates, context)
 
 
+def _calendar_window(year, month=None, week=None, day=None):
+    """
+    Returns the first and last days shown by a calendar of a month,
+    ISO week or day. Months are shown as the whole weeks they cover,
+    starting on Mondays. Raises ``ValueError`` for an invalid date.
+    """
+    year = int(year)
+    if day is not None:
+        first = date(year, int(month), int(day))
+        return first, first
+    if week is not None:
+        january_4th = date(year, 1, 4)
+        first = january_4th + timedelta(days=-january_4th.weekday(),
+                                        weeks=int(week) - 1)
+        if first.isocalendar()[:2] != (year, int(week)):
+            raise ValueError("Invalid week: %s" % week)
+        return first, first + timedelta(days=6)
+    first = date(year, int(month), 1)
+    last = (first + timedelta(days=31)).replace(day=1) - timedelta(days=1)
+    return (first - timedelta(days=first.weekday()),
+            last + timedelta(days=6 - last.weekday()))
+
+
+def _calendar_days(events, first, last, window_start, window_end):
+    """
+    Returns each day from ``first`` to ``last``, with the occurrences
+    of the given events on that day, in a single pass over the events
+    ordered by start. Occurrences spanning several days are added to
+    each of them, and those ending at midnight aren't added to the day
+    they end on.
+    """
+    occurrences = []
+    for event in events:
+        for start, end in event.get_occurrences(window_start, window_end):
+            occurrences.append((start, event.id, end, event))
+    days = [{"date": first + timedelta(days=i), "events": []}
+            for i in range((last - first).days + 1)]
+    for start, event_id, end, event in sorted(occurrences):
+        local_end = to_local(end)
+        start_day = (to_local(start).date() - first).days
+        end_day = (local_end.date() - first).days
+        if end > start and local_end.time() == time():
+            end_day -= 1
+        for i in range(max(start_day, 0), min(end_day, len(days) - 1) + 1):
+            days[i]["events"].append({"event": event, "start": start,
+                                      "end": end})
+    return days
+
+
+def event_calendar(request, year=None, month=None, week=None, day=None,
+                   format="html", template="agenda/event_calendar.html"):
+    """
+    Display a calendar of the events in a month, ISO week or day,
+    defaulting to the current month, or return it as JSON when
+    ``format`` is ``json``. Every event overlapping the calendar is
+    fetched in a single query on its start and effective end.
+    """
+    settings.use_editable()
+    if year is None:
+        today = to_local(timezone.now()).date()
+        year, month = today.year, today.month
+    try:
+        first, last = _calendar_window(year, month, week, day)
+    except ValueError:
+        raise Http404()
+    view = "day" if day is not None else "week" if week is not None else "month"
+    window_start = from_local(datetime.combine(first, time()))
+    window_end = from_local(datetime.combine(last + timedelta(days=1), time()))
+    events = Event.objects.published(for_user=request.user).filter(
+        start__lt=window_end, effective_end__gte=window_start)
+    events = events.select_related("location")
+    days = _calendar_days(events, first, last, window_start, window_end)
+    if view == "month":
+        month = int(month)
+        for calendar_day in days:
+            calendar_day["in_month"] = calendar_day["date"].month == month
+        month_start = date(int(year), month, 1)
+        previous = month_start - timedelta(days=1)
+        next = month_start + timedelta(days=31)
+        previous_url = reverse("event_calendar_month",
+                               args=(previous.year, previous.month))
+        next_url = reverse("event_calendar_month", args=(next.year, next.month))
+    elif view == "week":
+        previous = (first - timedelta(days=7)).isocalendar()
+        next = (first + timedelta(days=7)).isocalendar()
+        previous_url = reverse("event_calendar_week", args=previous[:2])
+        next_url = reverse("event_calendar_week", args=next[:2])
+    else:
+        previous, next = first - timedelta(days=1), first + timedelta(days=1)
+        previous_url = reverse("event_calendar_day",
+            args=(previous.year, previous.month, previous.day))
+        next_url = reverse("event_calendar_day",
+                           args=(next.year, next.month, next.day))
+    if format == "json":
+        for calendar_day in days:
+            calendar_day["events"] = [{
+                "id": occurrence["event"].id,
+                "title": occurrence["event"].title,
+                "url": occurrence["event"].get_absolute_url(),
+                "location": str(occurrence["event"].location or ""),
+                "start": occurrence["start"],
+                "end": occurrence["end"],
+            } for occurrence in calendar_day["events"]]
+        data = {"view": view, "start": first, "end": last, "days": days,
+                "previous": previous_url, "next": next_url}
+        return HttpResponse(json.dumps(data, cls=DjangoJSONEncoder),
+                            content_type="application/json")
+    context = {"view": view, "first": first, "last": last, "days": days,
+               "weeks": [days[i:i + 7] for i in range(0, len(days), 7)],
+               "previous_url": previous_url, "next_url": next_url}
+    return render(request, template, context)
+
+
+def event_search(request, format="html",
+                 template="agenda/event_search.html"):
+    """
+    Display the events matching the search query given by ``q``, most
+    relevant first and paginated by cursor, or return them as JSON
+    when ``format`` is ``json``.
+    """
+    settings.use_editable()
+    query = request.GET.get("q", "")
+    events = Event.objects.published(for_user=request.user)
+    events = search_events(query, request.GET.get("cursor"),
+                           settings.EVENT_PER_PAGE, events)
+    if format == "json":
+        data = {"query": query, "next": events.next_cursor, "results": [{
+            "id": event.id,
+            "title": event.title,
+            "url": event.get_absolute_url(),
+            "start": event.start,
+            "end": event.end,
+            "location": str(event.location or ""),
+        } for event in events]}
+        return HttpResponse(json.dumps(data, cls=DjangoJSONEncoder),
+                            content_type="application/json")
+    context = {"events": events, "query": query}
+    return render(request, template, context)
+
+
+def event_autocomplete(request):
+    """
+    Returns suggested events and locations for the partial search
+    query given by ``q`` as JSON, from an in-memory index so that no
+    database queries are needed.
+    """
+    try:
+        limit = min(int(request.GET.get("limit", 10)), 50)
+    except ValueError:
+        return HttpResponseBadRequest("limit must be a number.")
+    index = get_autocomplete_index()
+    suggestions = index.suggest(request.GET.get("q", ""), limit)
+    return HttpResponse(json.dumps(suggestions),
+                        content_type="application/json")
+
+
+def event_nearby(request):
+    """
+    Returns the upcoming events within a distance of a point as JSON,
+    nearest first. The point is given by the ``lat`` and ``lon`` query
+    parameters, the distance in kilometres by ``distance``, defaulting
+    to 10, and the maximum number of events by ``limit``.
+    """
+    try:
+        lat, lon = float(request.GET["lat"]), float(request.GET["lon"])
+        distance = float(request.GET.get("distance", 10))
+        limit = int(request.GET.get("limit", settings.EVENT_PER_PAGE))
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("lat and lon are required, and lat, "
+                                      "lon, distance and limit must be "
+                                      "numbers.")
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or distance < 0:
+        return HttpResponseBadRequest("lat, lon or distance out of range.")
+    events = Event.objects.published(for_user=request.user)
+    events = get_nearby_events(lat, lon, distance, limit, events)
+    data = [{
+        "id": event.id,
+        "title": event.title,
+        "url": event.get_absolute_url(),
+        "start": event.start,
+        "end": event.end,
+        "location": str(event.location),
+        "lat": event.location.lat,
+        "lon": event.location.lon,
+        "distance": round(event.distance, 3),
+    } for event in events]
+    return HttpResponse(json.dumps(data, cls=DjangoJSONEncoder),
+                        content_type="application/json")
+
+
+def _event_validators(events):
+    """
+    Returns an ETag and last modified time for a group of events, using
+    a single aggregate query over their last updated time and count.
+    The ETag also includes the agenda's cache version, and the last
+    modified time is no earlier than the version was last bumped, so
+    that both change when events are deleted or locations, keywords
+    or the events page change too.
+    """
+    aggregates = events.order_by().aggregate(last_modified=Max("updated"),
+                                             count=Count("id"))
+    last_modified = aggregates["last_modified"]
+    last_changed = get_last_changed()
+    if last_changed is not None:
+        last_modified = max(last_modified or last_changed, last_changed)
+    etag = md5(("%s|%s|%s|%s" % (__version__, get_cache_version(),
+        aggregates["count"], last_modified.isoformat()
+        if last_modified else "")).encode("utf-8"))
+    return etag.hexdigest(), last_modified
+
+
+def _conditional_response(request, events, get_response):
+    """
+    Handles conditional GET requests for a view whose response is
+    built from the given events. If the client's copy is still current
+    a 304 is returned without calling ``get_response`` to build the body,
+    otherwise its response is returned with ETag and Last-Modified set.
+    """
+    etag, last_modified = _event_validators(events)
+    if last_modified is not None:
+        last_modified = timegm(last_modified.utctimetuple())
+    not_modified = False
+    if request.method in ("GET", "HEAD"):
+        if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+        if_modified_since = request.META.get("HTTP_IF_MODIFIED_SINCE")
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            not_modified = etag in etags or "*" in etags
+        elif if_modified_since and last_modified is not None:
+            if_modified_since = parse_http_date_safe(if_modified_since)
+            not_modified = (if_modified_since is not None and
+                            last_modified <= if_modified_since)
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        response = get_response()
+    response["ETag"] = quote_etag(etag)
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified)
+    return response
+
+
+def _cached_response(key, get_response, timeout):
+    """
+    Returns a response from the cache, calling ``get_response`` to build
+    and cache it when it isn't cached. Only one request at a time builds
+    a missing response, while others wait briefly for it to be cached,
+    so that a cache miss under load doesn't build it many times over.
+    """
+    lock_key = "%s.lock" % key
+    cached = cache.get(key)
+    if cached is None and not cache.add(lock_key, True, 30):
+        for i in range(50):
+            sleep(.1)
+            cached = cache.get(key)
+            if cached is not None:
+                break
+    if cached is None:
+        try:
+            response = get_response()
+            if response.status_code == 200:
+                cached = (response.content, response["Content-Type"])
+                cache.set(key, cached, timeout)
+        finally:
+            cache.delete(lock_key)
+        return response
+    content, content_type = cached
+    return HttpResponse(content, content_type=content_type)
+
+
 def event_feed(request, format, **kwargs):
     """
-    Events feeds - maps format to the correct feed view.
+    Events feeds - maps format to the correct feed view. Feeds are
+    cached until events, locations or the events page change, and
+    archives of complete months are also cached by clients.
     """
     try:
-        return {"rss": EventsRSS, "atom": EventsAtom}[format](**kwargs)(request)
+        feed = {"rss": EventsRSS, "atom": EventsAtom}[format]
     except KeyError:
         raise Http404()
+    complete = False
+    if "year" in kwargs:
+        kwargs["year"], kwargs["month"] = int(kwargs["year"]), int(kwargs["month"])
+        try:
+            start, end = get_archive_range(kwargs["year"], kwargs["month"])
+        except ValueError:
+            raise Http404()
+        complete = end <= timezone.now()
+    else:
+        try:
+            kwargs["page"] = int(request.GET.get("page", 1))
+        except ValueError:
+            raise Http404()
+        if kwargs["page"] < 1:
+            raise Http404()
+    # Look up the filter objects before checking the validators, so
+    # that feeds for missing tags, locations or authors are a 404
+    # rather than a 304.
+    events = Event.objects.published()
+    if kwargs.get("tag"):
+        tag = get_object_or_404(Keyword, slug=kwargs["tag"])
+        events = events.filter(keywords__keyword=tag)
+    if kwargs.get("location"):
+        location = get_object_or_404(EventLocation, slug=kwargs["location"])
+        events = events.filter(location=location)
+    if kwargs.get("username"):
+        user = get_object_or_404(User, username=kwargs["username"])
+        events = events.filter(user=user)
+    # Feeds contain absolute URLs and translated text, so they're
+    # cached separately for each scheme, host and language.
+    variant = (sorted(kwargs.items()), request.is_secure(),
+               request.get_host(), get_language())
+    filters = md5(repr(variant).encode("utf-8")).hexdigest()
+    key = "mezzanine_agenda.%s.feed.%s.%s.%s" % (get_cache_version(), format,
+                                                current_site_id(), filters)
 
+    def get_response():
+        if settings.EVENT_RSS_LIMIT is None and "year" not in kwargs:
+            # Feeds of every event are streamed rather than cached.
+            return feed(**kwargs).stream(request)
+        timeout = None if complete else settings.EVENT_FEED_CACHE_SECONDS
+        response = _cached_response(key, lambda: feed(**kwargs)(request),
+                                    timeout)
+        if complete:
+            patch_response_headers(response, 60 * 60 * 24 * 365)
+        return response
 
-def _make_icalendar():
+    return _conditional_response(request, events, get_response)
+
+
+def _make_icalendar(since=None):
     """
-    Create an icalendar object.
+    Create an icalendar object, describing the timezone of event times
+    from ``since`` onwards.
     """
     icalendar = Calendar()
     icalendar.add('prodid',
         '-//mezzanine-agenda//NONSGML V{}//EN'.format(__version__))
     icalendar.add('version', '2.0') # version of the format, not the product!
+    vtimezone = get_vtimezone(since)
+    if vtimezone is not None:
+        icalendar.add_component(vtimezone)
     return icalendar
 
 
+def _icalendar_vevents(events):
+    """
+    Yield the stored serialized icalendar event for each of the given
+    events, rebuilding any that haven't been stored yet.
+    """
+    vevents = events.values_list("id", "icalendar_vevent")
+    for event_id, vevent in vevents.iterator():
+        if not vevent:
+            event = Event._base_manager.select_related("location").get(
+                id=event_id)
+            vevent = event.update_icalendar_vevent()
+        yield vevent.encode("utf-8")
+
+
+def _serialize_icalendar(vevents, since=None):
+    """
+    Yield an icalendar piece by piece, joining the given serialized
+    icalendar events, which start from ``since`` onwards, between the
+    calendar's header and footer.
+    """
+    empty_icalendar = _make_icalendar(since).to_ical()
+    footer_start = empty_icalendar.rindex(b"END:VCALENDAR")
+    yield empty_icalendar[:footer_start]
+    for vevent in vevents:
+        yield vevent
+    yield empty_icalendar[footer_start:]
+
+
 def icalendar_event(request, slug, year=None, month=None, day=None):
     """
     Returns the icalendar for a specific event.
     """
-    events = Event.objects.published(
-                                     for_user=request.user).select_related()
-    event = get_object_or_404(events, slug=slug)
+    events = Event.objects.published(for_user=request.user)
+    events = events.filter(slug=slug)
+    event = get_object_or_404(events.select_related())
 
-    icalendar = _make_icalendar()
-    icalendar_event = event.get_icalendar_event()
-    icalendar.add_component(icalendar_event)
+    def get_response():
+        vevent = event.icalendar_vevent or event.update_icalendar_vevent()
+        icalendar = _serialize_icalendar([vevent.encode("utf-8")],
+                                         event.start)
+        return HttpResponse(b"".join(icalendar), content_type="text/calendar")
 
-    return HttpResponse(icalendar.to_ical(), content_type="text/calendar")
+    return _conditional_response(request, events, get_response)
 
 
 def icalendar(request, tag=None, year=None, month=None, username=None,
@@ -134,13 +533,13 @@ def icalendar(request, tag=None, year=None, month=None, username=None,
         tag = get_object_or_404(Keyword, slug=tag)
         events = events.filter(keywords__keyword=tag)
     if year is not None:
-        events = events.filter(start__year=year)
+        try:
+            start, end = get_archive_range(year, month)
+        except ValueError:
+            raise Http404()
+        events = filter_occurring(events, start, end)
         if month is not None:
-            events = events.filter(start__month=month)
-            try:
-                month = month_name[int(month)]
-            except IndexError:
-                raise Http404()
+            month = month_name[int(month)]
     if location is not None:
         location = get_object_or_404(EventLocation, slug=location)
         events = events.filter(location=location)
@@ -150,14 +549,14 @@ def icalendar(request, tag=None, year=None, month=None, username=None,
         events = events.filter(user=author)
     if not tag and not year and not location and not username:
         #Get upcoming events/ongoing events
-        events = events.filter(Q(start__gt=datetime.now()) | Q(end__gt=datetime.now())).order_by("start")
-
-    prefetch = ("keywords__keyword",)
-    events = events.select_related("user").prefetch_related(*prefetch)
+        events = events.filter(effective_end__gt=timezone.now()).order_by("start")
 
-    icalendar = _make_icalendar()
-    for event in events:
-        icalendar_event = event.get_icalendar_event()
-        icalendar.add_component(icalendar_event)
+    def get_response():
+        since = events.aggregate(since=Min("start"))["since"]
+        icalendar = _serialize_icalendar(_icalendar_vevents(events), since)
+        if settings.EVENT_ICAL_STREAMING:
+            return StreamingHttpResponse(icalendar,
+                                         content_type="text/calendar")
+        return HttpResponse(b"".join(icalendar), content_type="text/calendar")
 
-    return HttpResponse(icalendar.to_ical(), content_type="text/calendar")
+    return _conditional_response(request, events, get_response)
@@ -26,6 +26,7 @@ setup(name='mezzanine-agenda',
         'icalendar==3.0.1b2',
         'geopy==0.95.1',
         'pytz',
+        'python-dateutil',
     ],
     classifiers = [
         'Development Status :: 4 - Beta',